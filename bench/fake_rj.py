@@ -0,0 +1,192 @@
+import asyncio
+import io
+import os
+import random
+import struct
+
+from aiohttp import web
+from PIL import Image
+
+ARTISTS = ["Ebi", "Googoosh", "Dariush", "Sattar", "Moein", "Hayedeh", "Shadmehr", "Siavash"]
+WORDS = ["Khalij", "Fars", "Pol", "Shab", "Gol", "Darya", "Baran", "Eshgh", "Yar", "Del"]
+
+
+def box(kind, payload):
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def fake_mp4(duration, size):
+    # Just enough MP4 for header probing: ftyp, a filler mdat, then a moov
+    # at the end like a file that was never faststarted.
+    mvhd = box(b"mvhd", b"\x00\x00\x00\x00" + struct.pack(">IIII", 0, 0, 1000, duration * 1000) + bytes(80))
+    head = box(b"ftyp", b"isom\x00\x00\x02\x00isomiso2mp41")
+    tail = box(b"moov", mvhd)
+    filler = max(size - len(head) - len(tail) - 8, 0)
+    return head + box(b"mdat", os.urandom(filler)) + tail
+
+
+class FakeRadioJavan:
+
+    def __init__(self, tracks=50, latency=0.0, jitter=0.0, bandwidth=None, failure_rate=0.0, drop_rate=0.0,
+                 audio_size=4 * 1048576, video_size=16 * 1048576, seed=None):
+        # latency/jitter in seconds per request, bandwidth in bytes per second
+        # per response, failure_rate answers API calls with 503 and drop_rate
+        # cuts media responses off halfway.
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.failures = 0
+        self.drops = 0
+        self.bytes_sent = 0
+        self.base_url = None
+        self.catalog = {}
+        for track_id in range(1, tracks + 1):
+            title = " ".join(self.random.sample(WORDS, 2))
+            self.catalog[track_id] = {
+                "id": track_id,
+                "artist": self.random.choice(ARTISTS),
+                "song": title,
+                "duration": self.random.randint(150, 330),
+            }
+        self.audio = os.urandom(audio_size)
+        self.video_size = video_size
+        self.videos = {}
+        image = Image.new("RGB", (320, 320), (51, 215, 255))
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG")
+        self.photo = buffer.getvalue()
+        self.app = web.Application(middlewares=[self.middleware])
+        self.app.router.add_get("/api2/search", self.search)
+        self.app.router.add_get("/api2/mp3", self.mp3)
+        self.app.router.add_get("/api2/video/{id}", self.video)
+        self.app.router.add_get("/media/mp3/{id}.mp3", self.audio_file)
+        self.app.router.add_get("/media/video/{id}.mp4", self.video_file)
+        self.app.router.add_get("/photo/{id}.jpg", self.photo_file)
+        self.runner = None
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        self.requests += 1
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if request.path.startswith("/api2/") and self.random.random() < self.failure_rate:
+            self.failures += 1
+            return web.Response(status=503)
+        return await handler(request)
+
+    def item(self, track, kind):
+        ext = "mp3" if kind == "mp3" else "mp4"
+        return {
+            "id": track["id"],
+            "artist": track["artist"],
+            "song": track["song"],
+            "link": f"{self.base_url}/media/{kind}/{track['id']}.{ext}",
+            "photo": f"{self.base_url}/photo/{track['id']}.jpg",
+        }
+
+    def track(self, request, track_id):
+        try:
+            return self.catalog[int(track_id)]
+        except (KeyError, ValueError):
+            raise web.HTTPNotFound()
+
+    async def search(self, request):
+        terms = request.query.get("query", "").lower().split()
+        found = [track for track in self.catalog.values()
+                 if all(term in f"{track['artist']} {track['song']}".lower() for term in terms)][:10]
+        return web.json_response({
+            "mp3s": [self.item(track, "mp3") for track in found],
+            "videos": [self.item(track, "video") for track in found[:5]],
+        })
+
+    async def mp3(self, request):
+        track = self.track(request, request.query.get("id"))
+        return web.json_response({**self.item(track, "mp3"), "duration": str(track["duration"])})
+
+    async def video(self, request):
+        return web.json_response(self.item(self.track(request, request.match_info["id"]), "video"))
+
+    async def audio_file(self, request):
+        self.track(request, request.match_info["id"])
+        return await self.send(request, self.audio, "audio/mpeg")
+
+    async def video_file(self, request):
+        track = self.track(request, request.match_info["id"])
+        if track["id"] not in self.videos:
+            self.videos[track["id"]] = fake_mp4(track["duration"], self.video_size)
+        return await self.send(request, self.videos[track["id"]], "video/mp4")
+
+    async def photo_file(self, request):
+        return web.Response(body=self.photo, content_type="image/jpeg")
+
+    async def send(self, request, body, content_type):
+        total = len(body)
+        start, end = 0, total - 1
+        status = 200
+        headers = {"Accept-Ranges": "bytes", "Content-Type": content_type}
+        if request.http_range.start is not None or request.http_range.stop is not None:
+            start = request.http_range.start or 0
+            if request.http_range.stop is not None:
+                end = min(request.http_range.stop, total) - 1
+            if start >= total:
+                return web.Response(status=416, headers={"Content-Range": f"bytes */{total}"})
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{total}"
+        headers["Content-Length"] = str(end - start + 1)
+        response = web.StreamResponse(status=status, headers=headers)
+        await response.prepare(request)
+        cut = start + (end - start + 1) // 2 if self.random.random() < self.drop_rate else None
+        chunk = 16384
+        position = start
+        while position <= end:
+            if cut is not None and position >= cut:
+                self.drops += 1
+                request.transport.close()
+                return response
+            data = body[position:min(position + chunk, end + 1)]
+            await response.write(data)
+            self.bytes_sent += len(data)
+            position += len(data)
+            if self.bandwidth:
+                await asyncio.sleep(len(data) / self.bandwidth)
+        await response.write_eof()
+        return response
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+async def serve(host, port, **options):
+    server = FakeRadioJavan(**options)
+    print(f"Fake RadioJavan API at {await server.start(host, port)}/api2")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the RadioJavan API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--bandwidth", type=float, default=None, help="bytes per second per response")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, latency=args.latency, jitter=args.jitter, bandwidth=args.bandwidth,
+                      failure_rate=args.failure_rate, drop_rate=args.drop_rate))
@@ -0,0 +1,115 @@
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+from bench.fake_rj import ARTISTS, WORDS, FakeRadioJavan
+from downloader import Downloader
+from radiojavan import AsyncRadioJavan
+
+QUERIES = [word.lower() for pair in zip(ARTISTS, WORDS) for word in pair]
+
+
+def summary(name, samples, unit="ms", scale=1000):
+    if not samples:
+        return f"{name:<28} no samples"
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    return (f"{name:<28} n={len(samples):<4} p50={statistics.median(samples) * scale:8.1f}{unit}"
+            f"  p95={p95 * scale:8.1f}{unit}  max={samples[-1] * scale:8.1f}{unit}")
+
+
+async def bench_search(client, rounds):
+    samples = []
+    for i in range(rounds):
+        started = time.perf_counter()
+        await client.search(QUERIES[i % len(QUERIES)])
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+async def bench_first_audio(client, downloader, directory, rounds):
+    # From typing a query to the first bytes of the chosen track on disk,
+    # and to the whole track being there.
+    first, complete = [], []
+    for i in range(rounds):
+        started = time.perf_counter()
+        results = await client.search(QUERIES[i % len(QUERIES)])
+        audio = next((result for result in results if result["type"] == "audio"), None)
+        if audio is None:
+            continue
+        track = await client.get_audio(audio["id"])
+        seen = []
+        async def progress(done, total):
+            if not seen and done:
+                seen.append(time.perf_counter() - started)
+        path = await downloader.download(track["link"], os.path.join(directory, f"first-{i}.mp3"), progress=progress)
+        complete.append(time.perf_counter() - started)
+        first.extend(seen[:1])
+        os.remove(path)
+    return first, complete
+
+
+async def bench_throughput(client, downloader, directory, concurrency):
+    results = await client.search("")
+    tracks = [result for result in results if result["type"] == "audio"][:concurrency]
+    started = time.perf_counter()
+    paths = await asyncio.gather(*[
+        downloader.download(track["link"], os.path.join(directory, f"bulk-{track['id']}.mp3"))
+        for track in tracks
+    ])
+    elapsed = time.perf_counter() - started
+    size = sum(os.path.getsize(path) for path in paths)
+    for path in paths:
+        os.remove(path)
+    return size, elapsed
+
+
+async def bench_video(client, rounds):
+    samples = []
+    for i in range(rounds):
+        started = time.perf_counter()
+        await client.get_video(i % 5 + 1)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+async def main(args):
+    server = FakeRadioJavan(latency=args.latency, jitter=args.jitter, bandwidth=args.bandwidth,
+                            failure_rate=args.failure_rate, drop_rate=args.drop_rate, seed=args.seed)
+    base_url = await server.start()
+    client = AsyncRadioJavan(f"{base_url}/api2", backoff=0.05)
+    downloader = Downloader(progress_interval=0)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            print(summary("search", await bench_search(client, args.rounds)))
+            first, complete = await bench_first_audio(client, downloader, directory, args.rounds)
+            print(summary("search to first audio", first))
+            print(summary("search to full track", complete))
+            requests = server.requests
+            print(summary("get_video (header probe)", await bench_video(client, args.rounds)))
+            print(f"{'video probe requests':<28} {(server.requests - requests) / args.rounds:.1f} per call")
+            size, elapsed = await bench_throughput(client, downloader, directory, args.concurrency)
+            print(f"{'download throughput':<28} {size / 1048576 / elapsed:.1f}MB/s"
+                  f" ({args.concurrency} parallel, {size / 1048576:.0f}MB in {elapsed:.2f}s)")
+    finally:
+        await client.close()
+        await downloader.close()
+        await server.stop()
+    print(f"{'server':<28} requests={server.requests} failures={server.failures} drops={server.drops}"
+          f" sent={server.bytes_sent / 1048576:.0f}MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the RadioJavan client and downloader against a local fake API.")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--bandwidth", type=float, default=None, help="bytes per second per response")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of API calls answered with 503")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="share of media responses cut off halfway")
+    parser.add_argument("--seed", type=int, default=None)
+    asyncio.run(main(parser.parse_args()))
@@ -1,19 +1,23 @@
 import time
 import asyncio
+import bisect
 import hashlib
+import io
+import itertools
+import json
 import logging
 import math
 import os
 import re
 import random
-import shutil
+import threading
+import uuid
+from collections import OrderedDict, deque
 from functools import wraps
-from moviepy.editor import VideoFileClip
 import aiofiles
 import sys
 import aiohttp
 import cv2
-import requests
 from colorama import Fore
 from configparser import ConfigParser
 from PIL import Image, ImageDraw, ImageFont
@@ -26,14 +30,18 @@ from pytgcalls import PyTgCalls, StreamType
 from pytgcalls import exceptions as tgerrors
 from pytgcalls import idle, types
 from pytgcalls.types import AudioPiped
-from pytgcalls.types.input_stream import AudioVideoPiped
+from pytgcalls.types.input_stream import (AudioVideoPiped, InputAudioStream,
+                                          InputStream)
 from pytgcalls.types.input_stream.quality import (MediumQualityAudio,
                                                   MediumQualityVideo)
-from radiojavan import RadioJavan
-from redis import Redis
+from downloader import Downloader
+from radiojavan import AsyncRadioJavan
+from redis.asyncio import BlockingConnectionPool, Redis
 
 os.makedirs("sessions", exist_ok=True)
 os.makedirs("config_py", exist_ok=True)
+os.makedirs("pcm", exist_ok=True)
+os.makedirs("demux", exist_ok=True)
 
 config = ConfigParser()
 
@@ -63,23 +71,686 @@ if sys.argv[1:]:
         SUDO_RG = [int(u[1]) for u in config.items("sudorg")]
         SUDO_USERS = [int(u[1]) for u in config.items("admins")]
         REDIS_URL = config.get("redis", "url")
+        REDIS_MAX_CONNECTIONS = config.getint("redis", "max_connections", fallback=32)
+        REDIS_POOL_TIMEOUT = config.getint("redis", "pool_timeout", fallback=10)
+        TRACK_CACHE_SIZE = config.getint("cache", "tracks", fallback=512)
+        MEDIA_QUOTA = config.getint("cache", "media_quota", fallback=2048)
+        SEARCH_CACHE_SIZE = config.getint("cache", "searches", fallback=256)
+        SEARCH_TTL = config.getint("cache", "search_ttl", fallback=600)
+        COVER_QUOTA = config.getint("cache", "covers", fallback=128)
+        PREFETCH_SECONDS = config.getint("player", "prefetch", fallback=10)
+        DOWNLOAD_WORKERS = config.getint("download", "workers", fallback=4)
+        DOWNLOAD_PER_CHAT = config.getint("download", "per_chat", fallback=2)
+        RJ_BASE_URL = config.get("radiojavan", "base_url", fallback=None)
     else:
         sys.exit(0)
 else:
     sys.exit(0)
 
 bot = Client(f"sessions/{ID_BOT}-bot-api", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
-redis = Redis.from_url(REDIS_URL, encoding='utf-8', decode_responses=True)
+redis = Redis(connection_pool=BlockingConnectionPool.from_url(REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT, encoding='utf-8', decode_responses=True))
 logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', filename='./errors.log')
 
-cli = Client(f"sessions/{ID_BOT}-bot-cli", api_id=API_ID, api_hash=API_HASH, in_memory=True, session_string=redis.get(f"{ID_BOT}:SessionString"))
+loop = asyncio.get_event_loop()
+SESSION_STRING = loop.run_until_complete(redis.get(f"{ID_BOT}:SessionString"))
+
+cli = Client(f"sessions/{ID_BOT}-bot-cli", api_id=API_ID, api_hash=API_HASH, in_memory=True, session_string=SESSION_STRING)
 pytgcalls = PyTgCalls(cli)
 
 
-class Playlist:
+class Cursor:
+
+    def __init__(self, keys, now=None, rule=None, order=None, pointer=-1):
+        self.keys = keys
+        self.scores = [int(key.split("-")[0]) for key in keys]
+        self.entries = {key.split("-")[1]: key for key in keys}
+        self.rule = rule
+        self.order = [self.find(score) for score in order or []]
+        self.order = [full for full in self.order if full]
+        self.pointer = min(pointer, len(self.order) - 1)
+        self.seek(now)
+
+    def locate(self, full):
+        return bisect.bisect_left(self.scores, int(full.split("-")[0]))
+
+    def find(self, score):
+        index = bisect.bisect_left(self.scores, score)
+        if index < len(self.scores) and self.scores[index] == score:
+            return self.keys[index]
+
+    def seek(self, key):
+        self.now = key
+        self.index = -1
+        if key in self.entries:
+            self.index = self.locate(self.entries[key])
+            self.step(self.entries[key])
+
+    def step(self, full):
+        # Keep the shuffle pointer on the entry that is actually playing, a
+        # track picked out of order is moved right after the played part.
+        if not self.order:
+            return
+        if self.pointer + 1 < len(self.order) and self.order[self.pointer + 1] == full:
+            self.pointer += 1
+        elif self.pointer > 0 and self.order[self.pointer - 1] == full:
+            self.pointer -= 1
+        elif self.pointer < 0 or self.order[self.pointer] != full:
+            index = self.order.index(full)
+            del self.order[index]
+            if index <= self.pointer:
+                self.pointer -= 1
+            self.pointer += 1
+            self.order.insert(self.pointer, full)
+
+    def shuffle(self, keep=False):
+        current = self.entries.get(self.now)
+        self.order = random.sample(self.keys, len(self.keys))
+        self.pointer = -1
+        if current and len(self.order) > 1:
+            index = self.order.index(current)
+            if keep:
+                self.order[0], self.order[index] = self.order[index], self.order[0]
+                self.pointer = 0
+            elif index == 0:
+                swap = random.randrange(1, len(self.order))
+                self.order[0], self.order[swap] = self.order[swap], self.order[0]
+
+    def insert(self, full):
+        index = self.locate(full)
+        self.keys.insert(index, full)
+        self.scores.insert(index, int(full.split("-")[0]))
+        self.entries[full.split("-")[1]] = full
+        if index <= self.index:
+            self.index += 1
+        if self.order:
+            self.order.insert(random.randint(self.pointer + 1, len(self.order)), full)
+
+    def remove(self, full):
+        index = self.locate(full)
+        if index == len(self.keys) or self.keys[index] != full:
+            return
+        del self.keys[index]
+        del self.scores[index]
+        del self.entries[full.split("-")[1]]
+        # Removing the playing entry leaves the cursor just before its
+        # successor, so the following next() still lands on it.
+        if index <= self.index:
+            self.index -= 1
+        if full in self.order:
+            index = self.order.index(full)
+            del self.order[index]
+            if index <= self.pointer:
+                self.pointer -= 1
+
+    def dump_order(self):
+        return ",".join(full.split("-")[0] for full in self.order)
+
+
+# Drops a whole playlist and the tracks it references in one round trip.
+# KEYS: queue, entries, shuffle, counter, NowPlaying, Status, PlayingRule, InProgress, media refs, holders
+# ARGV: chat id, track hash prefix, invalidation channel, origin, pending set prefix
+# Returns the dropped track keys and the media files no playlist references anymore.
+# Track hashes are shared between chats and only go with their last holder.
+CLEAR_PLAYLIST_SCRIPT = """
+local keys = {}
+local paths = {}
+for _, item in ipairs(redis.call("ZRANGE", KEYS[1], 0, -1)) do
+    local key = string.match(item, "^%d+%-(.+)$")
+    local fields = redis.call("HMGET", ARGV[2] .. key, "path", "id")
+    if fields[1] and redis.call("HINCRBY", KEYS[9], fields[1], -1) <= 0 then
+        redis.call("HDEL", KEYS[9], fields[1])
+        table.insert(paths, fields[1])
+    end
+    redis.call("SREM", ARGV[5] .. key, ARGV[1])
+    if redis.call("HINCRBY", KEYS[10], key, -1) <= 0 then
+        redis.call("HDEL", KEYS[10], key)
+        redis.call("DEL", ARGV[5] .. key)
+        if fields[2] then
+            redis.call("HDEL", KEYS[8], fields[2])
+        end
+        redis.call("DEL", ARGV[2] .. key)
+        redis.call("PUBLISH", ARGV[3], ARGV[4] .. ":" .. key)
+        table.insert(keys, key)
+    end
+end
+redis.call("DEL", KEYS[1], KEYS[2], KEYS[3], KEYS[4])
+redis.call("HDEL", KEYS[5], ARGV[1])
+redis.call("HDEL", KEYS[6], ARGV[1])
+redis.call("HDEL", KEYS[7], ARGV[1])
+return {keys, paths}
+"""
+
+
+# Lease scripts only touch the lease while it still holds the caller's token.
+# KEYS: lease  ARGV: token, ttl in ms
+RENEW_LEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS: lease  ARGV: token
+RELEASE_LEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+class TrackCache:
+
+    def __init__(self, size=512):
+        self.size = size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.items:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.items.move_to_end(key)
+        return dict(self.items[key])
+
+    def put(self, key, track):
+        # Store what HGETALL would return so hits and misses look the same.
+        self.items[key] = {field: str(value) for field, value in track.items()}
+        self.items.move_to_end(key)
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def drop(self, key=None):
+        if key is None:
+            self.items.clear()
+        else:
+            self.items.pop(key, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self.items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "ratio": self.hits / total if total else 0.0,
+        }
+
+
+class SearchCache:
+
+    def __init__(self, redis, size=256, ttl=600, min_prefix=3):
+        # Results are the same for every bot, so the Redis layer is shared.
+        self.redis = redis
+        self.size = size
+        self.ttl = ttl
+        self.min_prefix = min_prefix
+        self.items = OrderedDict()
+
+    @staticmethod
+    def normalize(query):
+        return " ".join(query.lower().split())
+
+    def key(self, query):
+        return f"Search:{query}"
+
+    def remember(self, query, results):
+        self.items[query] = (time.monotonic() + self.ttl, results)
+        self.items.move_to_end(query)
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def recall(self, query):
+        if query not in self.items:
+            return None
+        expires, results = self.items[query]
+        if expires < time.monotonic():
+            del self.items[query]
+            return None
+        self.items.move_to_end(query)
+        return results
+
+    def narrow(self, query):
+        # While someone is typing, the results for what they typed a moment
+        # ago usually already contain what they are looking for.
+        terms = query.split()
+        for end in range(len(query) - 1, self.min_prefix - 1, -1):
+            results = self.recall(query[:end])
+            if results is not None:
+                matches = [result for result in results if all(term in f"{result['artist']} {result['title']}".lower() for term in terms)]
+                return matches or None
+        return None
+
+    async def search(self, query, fetch, prefix=False):
+        results, _ = await self.lookup(query, fetch, prefix=prefix)
+        return results
+
+    async def lookup(self, query, fetch, prefix=False):
+        # Also says whether the results were only narrowed down from an
+        # earlier query. Those are a subset of its top results and should
+        # not be cached as the answer for this one anywhere else.
+        query = self.normalize(query)
+        results = self.recall(query)
+        if results is None and prefix:
+            results = self.narrow(query)
+            if results is not None:
+                return results, True
+        if results is None:
+            cached = await self.redis.get(self.key(query))
+            if cached:
+                results = json.loads(cached)
+            else:
+                results = await fetch(query)
+                await self.redis.set(self.key(query), json.dumps(results), ex=self.ttl)
+            self.remember(query, results)
+        return results, False
+
+
+class DurationCache:
 
     def __init__(self, redis):
         self.redis = redis
+        self.key = "RadioJavan:Durations"
+
+    async def get(self, video_id):
+        return await self.redis.hget(self.key, video_id)
+
+    async def set(self, video_id, duration):
+        await self.redis.hset(self.key, video_id, duration)
+
+
+class CoverRenderer:
+
+    def __init__(self, client, foreground="files/foreground.png", font="files/font.otf", size=(1280, 720), font_size=32):
+        # The template never changes, so it is scaled and loaded once and
+        # every cover is drawn on a copy of it.
+        self.client = client
+        self.size = size
+        with Image.open(foreground) as image:
+            self.foreground = image.resize(size).convert("RGBA")
+        self.font = ImageFont.truetype(font, font_size)
+        # FreeType faces are not safe to render from two threads at once.
+        self.font_lock = threading.Lock()
+        self._username = None
+
+    async def username(self):
+        if self._username is None:
+            self._username = (await self.client.get_me()).username
+        return self._username
+
+    def render(self, filename, artist, title, duration, username, thumbnail=None):
+        if thumbnail is not None:
+            with Image.open(thumbnail) as background:
+                img = Image.alpha_composite(background.resize(self.size).convert("RGBA"), self.foreground)
+        else:
+            img = self.foreground.copy()
+        draw = ImageDraw.Draw(img)
+        lines = [(f"Artist: {artist}", (51, 215, 255)), (f"Title: {title}", (51, 215, 255))]
+        if duration:
+            lines.append((f"Duration: {duration}", (255, 255, 255)))
+        lines.append((f"By: @{username}", (255, 255, 255)))
+        with self.font_lock:
+            for i, (text, color) in enumerate(lines):
+                draw.text((205, 550 + 40 * i), text, color, font=self.font)
+        img.save(filename, format="PNG")
+        return filename
+
+    async def draw(self, filename, artist, title, duration=None, thumbnail=None):
+        username = await self.username()
+        return await asyncio.get_running_loop().run_in_executor(None, self.render, filename, artist, title, duration, username, thumbnail)
+
+
+class CoverCache:
+
+    def __init__(self, client, renderer, format_duration=str, directory="covers", quota=128, connections=4, timeout=10):
+        # Covers are named after everything drawn on them, so a track always
+        # maps to the same file. Least recently used ones are dropped once the
+        # directory outgrows the quota and drawn again when asked for.
+        self.client = client
+        self.renderer = renderer
+        self.format_duration = format_duration
+        self.directory = directory
+        self.quota = quota * 1048576
+        self.connections = connections
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.size = 0
+        self.calls = dict()
+        self._session = None
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.connections)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def path(self, artist, title, type, duration, artwork):
+        name = hashlib.md5(f"{artist}-{title}-{type}-{duration}-{artwork}".encode()).hexdigest()
+        return f"{self.directory}/{name}.png"
+
+    async def artwork(self, source):
+        # URLs come from RadioJavan, Telegram thumbnails are kept as file ids
+        # and older tracks may still point at a local file.
+        try:
+            if os.path.exists(source):
+                async with aiofiles.open(source, mode="rb") as f:
+                    return await f.read()
+            if source.startswith(("http://", "https://")):
+                async with self.session.get(source) as resp:
+                    return await resp.read() if resp.status == 200 else None
+            return (await self.client.download_media(source, in_memory=True)).getvalue()
+        except Exception as e:
+            logging.error(f"Could not fetch artwork {source}: {e}")
+            return None
+
+    async def get(self, artist, title, type="audio", duration=None, artwork=None):
+        # Tracks without artwork store none at all, treat "" the same.
+        artwork = artwork or None
+        path = self.path(artist, title, type, duration, artwork)
+        try:
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+        if path not in self.calls:
+            self.calls[path] = asyncio.ensure_future(self.draw(path, artist, title, type, duration, artwork))
+            self.calls[path].add_done_callback(lambda _: self.calls.pop(path, None))
+        return await asyncio.shield(self.calls[path])
+
+    async def draw(self, path, artist, title, type, duration, artwork):
+        data = await self.artwork(artwork) if artwork else None
+        if duration:
+            duration = self.format_duration(duration)
+        part = f"{path}.part"
+        try:
+            await self.renderer.draw(part, artist, title, duration, thumbnail=io.BytesIO(data) if data else None)
+        except OSError as e:
+            # Artwork Pillow cannot decode, fall back to the bare template.
+            logging.error(f"Could not draw artwork {artwork}: {e}")
+            await self.renderer.draw(part, artist, title, duration)
+        os.replace(part, path)
+        self.size += os.path.getsize(path)
+        if self.size > self.quota:
+            await asyncio.get_running_loop().run_in_executor(None, self.evict)
+        return path
+
+    def evict(self):
+        # Down to 90% of the quota so every new cover does not trigger a pass.
+        files = []
+        for name in os.listdir(self.directory):
+            path = f"{self.directory}/{name}"
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        self.size = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if self.size <= self.quota * 0.9:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError as e:
+                logging.error(f"Could not remove {path}: {e}")
+
+    def scan(self):
+        self.evict()
+        return self.size
+
+
+class MediaCache:
+
+    def __init__(self, redis, directory="media", quota=2048, grace=600):
+        # Shared by every bot running from this directory, so the keys are
+        # not namespaced by bot id.
+        self.redis = redis
+        self.directory = directory
+        self.quota = quota * 1048576
+        self.grace = grace
+        self.sources_key = "Media:Sources"
+        self.refs_key = "Media:Refs"
+        self.sizes_key = "Media:Sizes"
+        self.lru_key = "Media:LRU"
+        os.makedirs(directory, exist_ok=True)
+
+    def owns(self, path):
+        return os.path.dirname(path) == self.directory
+
+    def companions(self, path):
+        return [path, f"{path}.idx", pcm_path(path), demux_path(path)]
+
+    def measure(self, path):
+        return sum(os.path.getsize(p) for p in self.companions(path) if os.path.exists(p))
+
+    @staticmethod
+    def digest(path):
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1048576), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    async def lookup(self, source):
+        path = await self.redis.hget(self.sources_key, source)
+        if not path:
+            return None
+        if not os.path.exists(path):
+            await self.redis.hdel(self.sources_key, source)
+            return None
+        await self.touch(path)
+        return path
+
+    async def store(self, source, path):
+        digest = await asyncio.get_running_loop().run_in_executor(None, self.digest, path)
+        _, ext = os.path.splitext(path)
+        target = f"{self.directory}/{digest}{ext}"
+        if os.path.exists(target):
+            os.remove(path)
+        else:
+            os.replace(path, target)
+        pipe = self.redis.pipeline()
+        pipe.hset(self.sources_key, source, target)
+        pipe.hset(self.sizes_key, target, self.measure(target))
+        pipe.zadd(self.lru_key, {target: time.time()})
+        await pipe.execute()
+        await self.evict()
+        return target
+
+    async def index(self, source, path):
+        if self.owns(path) and os.path.exists(path):
+            await self.redis.hsetnx(self.sources_key, source, path)
+
+    async def touch(self, path):
+        if self.owns(path):
+            await self.redis.zadd(self.lru_key, {path: time.time()})
+
+    async def account(self, path):
+        # Sidecar and transcoded files count against the quota too.
+        if self.owns(path) and os.path.exists(path):
+            await self.redis.hset(self.sizes_key, path, self.measure(path))
+
+    async def evict(self):
+        sizes = await self.redis.hgetall(self.sizes_key)
+        total = sum(int(size) for size in sizes.values())
+        if total <= self.quota:
+            return 0
+        # Recently used files are left alone so a track that was just looked
+        # up is not removed before its playlist entry references it.
+        candidates = await self.redis.zrangebyscore(self.lru_key, "-inf", time.time() - self.grace)
+        if not candidates:
+            return 0
+        refs = await self.redis.hmget(self.refs_key, candidates)
+        loop = asyncio.get_running_loop()
+        removed = 0
+        for path, count in zip(candidates, refs):
+            if total <= self.quota:
+                break
+            if int(count or 0) > 0:
+                continue
+            for companion in self.companions(path):
+                try:
+                    await loop.run_in_executor(None, os.remove, companion)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logging.error(f"Could not remove {companion}: {e}")
+            pipe = self.redis.pipeline()
+            pipe.hdel(self.sizes_key, path)
+            pipe.zrem(self.lru_key, path)
+            pipe.hdel(self.refs_key, path)
+            await pipe.execute()
+            total -= int(sizes.get(path, 0))
+            removed += 1
+        return removed
+
+    async def scan(self):
+        # The directory is the source of truth: forget files that are gone
+        # and pick up ones the index lost.
+        files = {}
+        for name in os.listdir(self.directory):
+            if name.endswith((".part", ".idx")):
+                continue
+            path = f"{self.directory}/{name}"
+            files[path] = self.measure(path)
+        known = await self.redis.hgetall(self.sizes_key)
+        sources = await self.redis.hgetall(self.sources_key)
+        pipe = self.redis.pipeline()
+        for path in set(known) - set(files):
+            pipe.hdel(self.sizes_key, path)
+            pipe.zrem(self.lru_key, path)
+            pipe.hdel(self.refs_key, path)
+        for source, path in sources.items():
+            if path not in files:
+                pipe.hdel(self.sources_key, source)
+        for path, size in files.items():
+            pipe.hset(self.sizes_key, path, size)
+            pipe.zadd(self.lru_key, {path: os.path.getmtime(path)}, nx=True)
+        await pipe.execute()
+        return len(files)
+
+
+class SingleFlight:
+
+    def __init__(self, redis, lease=60, poll=0.5):
+        self.redis = redis
+        self.lease = lease
+        self.poll = poll
+        self.calls = dict()
+        self.renew_script = redis.register_script(RENEW_LEASE_SCRIPT)
+        self.release_script = redis.register_script(RELEASE_LEASE_SCRIPT)
+
+    async def do(self, key, job):
+        # Callers asking for a key while its job is running await that job
+        # instead of starting their own. A caller going away does not cancel
+        # the job for the others.
+        if key not in self.calls:
+            self.calls[key] = asyncio.ensure_future(job())
+            self.calls[key].add_done_callback(lambda _: self.calls.pop(key, None))
+        return await asyncio.shield(self.calls[key])
+
+    async def leased(self, key, job, ready):
+        # The same across processes: whoever holds the Redis lease runs the
+        # job, everyone else polls ready() until the result shows up or the
+        # lease is free to take over.
+        name = f"Lease:{key}"
+        token = uuid.uuid4().hex
+        while not await self.redis.set(name, token, nx=True, px=self.lease * 1000):
+            result = await ready()
+            if result:
+                return result
+            await asyncio.sleep(self.poll)
+        renew = asyncio.ensure_future(self.renew(name, token))
+        try:
+            return await ready() or await job()
+        finally:
+            renew.cancel()
+            await self.release_script(keys=[name], args=[token])
+
+    async def renew(self, name, token):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            await self.renew_script(keys=[name], args=[token, self.lease * 1000])
+
+
+class FetchPool:
+
+    def __init__(self, fetch, workers=4, per_chat=2):
+        self.fetch = fetch
+        self.workers = workers
+        self.per_chat = per_chat
+        self.queue = asyncio.PriorityQueue()
+        self.jobs = dict()
+        self.progress = dict()
+        self.running = set()
+        self.active = dict()
+        self.deferred = dict()
+        self.counter = itertools.count()
+
+    def ensure(self, chat_id, key, priority=0, progress=None):
+        # Lower priorities run first, callers pass the playlist position so
+        # tracks are fetched in the order they will play.
+        if progress:
+            self.progress[key] = progress
+        if key not in self.jobs:
+            self.jobs[key] = asyncio.get_running_loop().create_future()
+        if key not in self.running:
+            self.queue.put_nowait((priority, next(self.counter), chat_id, key))
+        return self.jobs[key]
+
+    async def wait(self, chat_id, key, progress=None):
+        # Something is about to play this track, jump the queue.
+        return await asyncio.shield(self.ensure(chat_id, key, priority=-1, progress=progress))
+
+    def start(self, loop):
+        for _ in range(self.workers):
+            loop.create_task(self.work())
+
+    async def work(self):
+        while True:
+            item = await self.queue.get()
+            priority, _, chat_id, key = item
+            future = self.jobs.get(key)
+            if future is None or key in self.running:
+                continue
+            # The per-chat limit keeps background downloads fair, a track
+            # someone is waiting to play is not held back by it.
+            if priority >= 0 and self.active.get(chat_id, 0) >= self.per_chat:
+                self.deferred.setdefault(chat_id, []).append(item)
+                continue
+            self.running.add(key)
+            self.active[chat_id] = self.active.get(chat_id, 0) + 1
+            try:
+                future.set_result(await self.fetch(chat_id, key, self.progress.get(key)))
+            except Exception as e:
+                logging.error(f"Fetching {key} for {chat_id} failed: {e}")
+                future.set_result(None)
+            finally:
+                self.running.discard(key)
+                self.jobs.pop(key, None)
+                self.progress.pop(key, None)
+                self.active[chat_id] -= 1
+                for item in self.deferred.pop(chat_id, []):
+                    self.queue.put_nowait(item)
+
+
+class Playlist:
+
+    def __init__(self, redis, media, cache_size=512):
+        self.redis = redis
+        self.media = media
+        self.cursors = dict()
+        self.cache = TrackCache(cache_size)
+        self.origin = uuid.uuid4().hex
+        self.trash = asyncio.Queue()
+        self.holders_key = f"{BOT_ID}:Holders"
+        self.clear_script = redis.register_script(CLEAR_PLAYLIST_SCRIPT)
     
     def convert_seconds(self, seconds):
         seconds = int(float(seconds))
@@ -94,28 +765,86 @@ class Playlist:
     def md5(self, string):
         return hashlib.md5(string.encode()).hexdigest()
 
-    def compress(self, track):
+    def track_key(self, key):
+        return f"{BOT_ID}:Track:{key}"
+
+    async def compress(self, track):
         key = self.md5(f"{track['identifier']}/{track['id']}")
-        keys = ','.join(track.keys())
-        self.redis.hset(f"{BOT_ID}:Keys", key, keys)
-        for i in track.keys():
-            self.redis.hset(f"{BOT_ID}:Detail-{i}", key, track[i])
+        self.cache.put(key, track)
+        pipe = self.redis.pipeline()
+        pipe.delete(self.track_key(key))
+        pipe.hset(self.track_key(key), mapping=track)
+        pipe.publish(f"{BOT_ID}:TrackInvalidate", f"{self.origin}:{key}")
+        await pipe.execute()
         return key
 
-    def extract(self, key):
-        result = dict()
-        keys = self.redis.hget(f"{BOT_ID}:Keys", key).split(",")
+    async def extract(self, key):
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+        result = await self.redis.hgetall(self.track_key(key))
+        if not result:
+            result = await self.migrate(key)
+        if result:
+            self.cache.put(key, result)
+        return result
+
+    async def watch(self):
+        # Other processes sharing this Redis publish every track they rewrite
+        # or delete, drop those keys so the local cache never serves stale
+        # metadata. Anything could have changed while disconnected, so a
+        # dropped subscription also empties the cache.
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(f"{BOT_ID}:TrackInvalidate")
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    origin, key = message["data"].split(":", 1)
+                    if origin != self.origin:
+                        self.cache.drop(key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Track invalidation listener failed: {e}")
+                self.cache.drop()
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.reset()
+
+    async def migrate(self, key):
+        # Tracks written before the single-hash layout keep one field per
+        # `Detail-{field}` hash, move them over the first time they are read.
+        keys = await self.redis.hget(f"{BOT_ID}:Keys", key)
+        if not keys:
+            return dict()
+        keys = keys.split(",")
+        pipe = self.redis.pipeline()
         for i in keys:
-            result[i] = self.redis.hget(f"{BOT_ID}:Detail-{i}", key)
+            pipe.hget(f"{BOT_ID}:Detail-{i}", key)
+        result = {i: value for i, value in zip(keys, await pipe.execute()) if value is not None}
+        pipe = self.redis.pipeline()
+        if result and not await self.redis.exists(self.track_key(key)):
+            pipe.hset(self.track_key(key), mapping=result)
+        for i in keys:
+            pipe.hdel(f"{BOT_ID}:Detail-{i}", key)
+        pipe.hdel(f"{BOT_ID}:Keys", key)
+        await pipe.execute()
         return result
 
-    def display(self, key, played_time=0):
-        datas = self.extract(key)
+    async def migrate_legacy(self, count=100):
+        _, keys = await self.redis.hscan(f"{BOT_ID}:Keys", 0, count=count)
+        for key in keys:
+            await self.migrate(key)
+        return len(keys)
+
+    async def display(self, key, played_time=0):
+        datas = await self.extract(key)
         result = ""
         if not played_time:
             played_time = 2
-        if datas.get("seek"):
-            played_time += eval(datas["seek"])
+        played_time += self.offset(datas)
         if "artist" in datas.keys():
             result += f"🗣 خواننده : {datas['artist']}\n"
         if "title" in datas.keys():
@@ -127,13 +856,83 @@ class Playlist:
             result += f"⏱ زمان : {self.convert_seconds(datas['duration'])} - {self.convert_seconds(played_time)}"
         return result
 
-    def get(self, chat_id):
-        if self.redis.scard(f"{BOT_ID}:Playlist:{chat_id}") == 0:
-            return []
-        return sorted(list(self.redis.smembers(f"{BOT_ID}:Playlist:{chat_id}")))
+    def queue_key(self, chat_id):
+        return f"{BOT_ID}:Queue:{chat_id}"
+
+    def entries_key(self, chat_id):
+        return f"{BOT_ID}:Entries:{chat_id}"
+
+    async def migrate_queues(self):
+        # Playlists used to be plain sets of "{counter}-{md5}" members, rescore
+        # them by their numeric counter into the sorted set layout.
+        async for legacy in self.redis.scan_iter(f"{BOT_ID}:Playlist:*"):
+            chat_id = legacy.rsplit(":", 1)[1]
+            items = sorted(await self.redis.smembers(legacy), key=lambda item: (self.split_key(item)[0], item))
+            items = [f"{score}-{self.split_key(item)[1]}" for score, item in enumerate(items, 1)]
+            pipe = self.redis.pipeline()
+            if items:
+                pipe.zadd(self.queue_key(chat_id), {item: self.split_key(item)[0] for item in items})
+                pipe.hset(self.entries_key(chat_id), mapping={self.split_key(item)[1]: item for item in items})
+                pipe.set(f"{BOT_ID}:QueueSeq:{chat_id}", len(items))
+            pipe.delete(legacy)
+            await pipe.execute()
+
+    async def count_holders(self):
+        # Track hashes are shared by every playlist entry pointing at them.
+        # Recount from the playlists themselves, which also covers entries
+        # added before the count was kept.
+        holders = dict()
+        async for entries in self.redis.scan_iter(self.entries_key("*")):
+            for key in await self.redis.hkeys(entries):
+                holders[key] = holders.get(key, 0) + 1
+        pipe = self.redis.pipeline()
+        pipe.delete(self.holders_key)
+        if holders:
+            pipe.hset(self.holders_key, mapping=holders)
+        await pipe.execute()
+
+    async def cursor(self, chat_id):
+        if chat_id not in self.cursors:
+            pipe = self.redis.pipeline()
+            pipe.zrange(self.queue_key(chat_id), 0, -1)
+            pipe.hget(f"{BOT_ID}:NowPlaying", chat_id)
+            pipe.hget(f"{BOT_ID}:PlayingRule", chat_id)
+            pipe.hmget(self.shuffle_key(chat_id), "order", "pointer")
+            keys, now, rule, (order, pointer) = await pipe.execute()
+            order = [int(score) for score in order.split(",")] if order else []
+            # Another coroutine may have loaded the chat while this one waited.
+            self.cursors.setdefault(chat_id, Cursor(keys, now, rule, order, int(pointer or -1)))
+        return self.cursors[chat_id]
+
+    def pending_key(self, key):
+        return f"{BOT_ID}:Pending:{key}"
+
+    def shuffle_key(self, chat_id):
+        return f"{BOT_ID}:Shuffle:{chat_id}"
+
+    def save_shuffle(self, chat_id, cursor, pipe):
+        if cursor.order:
+            pipe.hset(self.shuffle_key(chat_id), mapping={"order": cursor.dump_order(), "pointer": cursor.pointer})
+        else:
+            pipe.delete(self.shuffle_key(chat_id))
+
+    async def get(self, chat_id):
+        return list((await self.cursor(chat_id)).keys)
+
+    async def count(self, chat_id):
+        return len((await self.cursor(chat_id)).keys)
+
+    async def at(self, chat_id, index):
+        keys = (await self.cursor(chat_id)).keys
+        return keys[index] if 0 <= index < len(keys) else None
+
+    async def first(self, chat_id):
+        return await self.at(chat_id, 0)
 
-    def get_name(self, key):
-        datas = self.extract(key)
+    async def get_name(self, key):
+        return self.format_name(await self.extract(key))
+
+    def format_name(self, datas):
         result = ""
         if "artist" in datas.keys():
             result += f"{datas['artist']} - "
@@ -145,132 +944,382 @@ class Playlist:
         result = f"{icon} {result}"
         return result
 
-    def add(self, chat_id, track):
-        _id = self.compress(track)
-        if self.redis.sscan(f"{BOT_ID}:Playlist:{chat_id}", 0, f"*-{_id}")[1]:
+    async def page(self, chat_id, page, per_page=10):
+        # Entries come from the cursor, names for the ones missing from the
+        # local cache are fetched in a single pipeline.
+        cursor = await self.cursor(chat_id)
+        pages = math.ceil(len(cursor.keys) / per_page)
+        start = page * per_page
+        keys = [self.split_key(item)[1] for item in cursor.keys[start:start + per_page]]
+        datas = {key: self.cache.get(key) for key in keys}
+        missing = [key for key, value in datas.items() if value is None]
+        if missing:
+            pipe = self.redis.pipeline()
+            for key in missing:
+                pipe.hgetall(self.track_key(key))
+            for key, value in zip(missing, await pipe.execute()):
+                if not value:
+                    value = await self.migrate(key)
+                if value:
+                    self.cache.put(key, value)
+                datas[key] = value
+        rows = [(possition, key, self.format_name(datas[key])) for possition, key in enumerate(keys, start + 1)]
+        return pages, rows
+
+    async def add(self, chat_id, track):
+        _id = await self.compress(track)
+        cursor = await self.cursor(chat_id)
+        if _id in cursor.entries:
+            return False, _id
+        counter = await self.redis.incr(f"{BOT_ID}:QueueSeq:{chat_id}")
+        if not await self.redis.hsetnx(self.entries_key(chat_id), _id, f"{counter}-{_id}"):
             return False, _id
-        counter = self.redis.scard(f"{BOT_ID}:Playlist:{chat_id}") + 1
-        self.redis.sadd(f"{BOT_ID}:Playlist:{chat_id}", f"{counter}-{_id}")
+        cursor.insert(f"{counter}-{_id}")
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.queue_key(chat_id), {f"{counter}-{_id}": counter})
+        pipe.hincrby(self.holders_key, _id, 1)
+        if track.get("path"):
+            pipe.hincrby(self.media.refs_key, track["path"], 1)
+        else:
+            pipe.sadd(self.pending_key(_id), chat_id)
+        self.save_shuffle(chat_id, cursor, pipe)
+        await pipe.execute()
         return True, _id
 
-    def get_full_form(self, chat_id, key):
-        return self.redis.sscan(f"{BOT_ID}:Playlist:{chat_id}", 0, f"*-{key}")[1][0]
-
-    def get_possition(self, chat_id, key):
-        _list = self.get(chat_id)
-        full = self.get_full_form(chat_id, key)
-        return _list.index(full) + 1
-
-    def rem(self, chat_id, _id):
-        full = self.get_full_form(chat_id, _id)
-        self.clear_data(_id)
-        self.redis.srem(f"{BOT_ID}:Playlist:{chat_id}", full)
+    async def resolve(self, key, path):
+        # A pending track got its media, take the references its playlist
+        # entries could not take when they were added.
+        track = await self.extract(key)
+        if not track:
+            return None
+        track["path"] = path
+        await self.compress(track)
+        chats = list(await self.redis.smembers(self.pending_key(key)))
+        pipe = self.redis.pipeline()
+        for chat_id in chats:
+            pipe.hexists(self.entries_key(chat_id), key)
+        holders = await pipe.execute() if chats else []
+        pipe = self.redis.pipeline()
+        for held in holders:
+            if held:
+                pipe.hincrby(self.media.refs_key, path, 1)
+        pipe.delete(self.pending_key(key))
+        await pipe.execute()
+        return track
+
+    async def get_full_form(self, chat_id, key):
+        return (await self.cursor(chat_id)).entries.get(key)
+
+    async def get_possition(self, chat_id, key):
+        cursor = await self.cursor(chat_id)
+        return cursor.locate(cursor.entries[key]) + 1
+
+    async def rem(self, chat_id, _id):
+        cursor = await self.cursor(chat_id)
+        full = cursor.entries.get(_id)
+        # The entry is claimed first, a second remove of the same track (an
+        # old playlist message pressed twice) must not release it again.
+        if full is None or not await self.redis.hdel(self.entries_key(chat_id), _id):
+            return False
+        await self.redis.srem(self.pending_key(_id), chat_id)
+        await self.clear_data(_id)
+        cursor.remove(full)
+        pipe = self.redis.pipeline()
+        pipe.zrem(self.queue_key(chat_id), full)
+        self.save_shuffle(chat_id, cursor, pipe)
+        await pipe.execute()
         return True
 
+    def offset(self, track):
+        # Where the current stream started inside the track. Older entries
+        # carry the raw "+10-5" deltas instead of an absolute offset.
+        seek = track.get("seek")
+        if not seek:
+            return 0
+        try:
+            return float(seek)
+        except ValueError:
+            return sum(int(delta) for delta in re.findall(r"[+-]\d+", seek))
+
     def split_key(self, key):
         possition, value = key.split("-")
         return int(possition), value
 
-    def now(self, chat_id):
-        return self.redis.hget(f"{BOT_ID}:NowPlaying", chat_id) or None
+    async def now(self, chat_id):
+        return (await self.cursor(chat_id)).now or None
 
-    def play(self, chat_id, key):
-        self.redis.hset(f"{BOT_ID}:NowPlaying", chat_id, key)
-        self.redis.hset(f"{BOT_ID}:Status", chat_id, "play")
+    async def play(self, chat_id, key):
+        cursor = await self.cursor(chat_id)
+        cursor.seek(key)
+        pipe = self.redis.pipeline()
+        pipe.hset(f"{BOT_ID}:NowPlaying", chat_id, key)
+        pipe.hset(f"{BOT_ID}:Status", chat_id, "play")
+        self.save_shuffle(chat_id, cursor, pipe)
+        await pipe.execute()
 
-    def pause(self, chat_id):
-        self.redis.hset(f"{BOT_ID}:Status", chat_id, "pause")
+    async def pause(self, chat_id):
+        await self.redis.hset(f"{BOT_ID}:Status", chat_id, "pause")
 
-    def resume(self, chat_id):
-        self.redis.hset(f"{BOT_ID}:Status", chat_id, "play")
+    async def resume(self, chat_id):
+        await self.redis.hset(f"{BOT_ID}:Status", chat_id, "play")
 
-    def status(self, chat_id):
-        return self.redis.hget(f"{BOT_ID}:Status", chat_id)
+    async def status(self, chat_id):
+        return await self.redis.hget(f"{BOT_ID}:Status", chat_id)
 
-    def rule(self, chat_id):
-        return self.redis.hget(f"{BOT_ID}:PlayingRule", chat_id)
+    async def rule(self, chat_id):
+        return (await self.cursor(chat_id)).rule
 
-    def set_rule(self, chat_id, rule):
-        self.redis.hset(f"{BOT_ID}:PlayingRule", chat_id, rule)
-
-    def clear_data(self, key):
-        keys = self.redis.hget(f"{BOT_ID}:Keys", key).split(",")
-        for i in keys:
-            if i == "link":
-                path = self.redis.hget(f"{BOT_ID}:Detail-{i}", key)
-                if os.path.exists(path):
-                    os.remove(path)
-            if i == "id":
-                _id = self.redis.hget(f"{BOT_ID}:Detail-{i}", key)
-                self.redis.hdel(f"{BOT_ID}:InProgress", _id)
-            self.redis.hdel(f"{BOT_ID}:Detail-{i}", key)
-        self.redis.hdel(f"{BOT_ID}:Keys", key)
-
-    def clear(self, chat_id):
-        for item in self.get(chat_id):
-            _, _id = self.split_key(item)
-            self.clear_data(_id)
-            self.redis.srem(f"{BOT_ID}:Playlist:{chat_id}", item)
-        self.redis.hdel(f"{BOT_ID}:PlayingRule", chat_id)
-        self.redis.hdel(f"{BOT_ID}:Status", chat_id)
-        self.redis.hdel(f"{BOT_ID}:NowPlaying", chat_id)
-
-    def next(self, chat_id, force=False):
-        current = self.get_full_form(chat_id, self.now(chat_id))
-        playlist = self.get(chat_id)
-        rule = self.rule(chat_id)
-        index = playlist.index(current) + 1
+    async def set_rule(self, chat_id, rule):
+        cursor = await self.cursor(chat_id)
+        cursor.rule = rule
+        if rule == "shuffle":
+            cursor.shuffle(keep=True)
+        else:
+            cursor.order, cursor.pointer = [], -1
+        pipe = self.redis.pipeline()
+        pipe.hset(f"{BOT_ID}:PlayingRule", chat_id, rule)
+        self.save_shuffle(chat_id, cursor, pipe)
+        await pipe.execute()
+
+    async def audio_only(self, chat_id):
+        return await self.redis.hget(f"{BOT_ID}:AudioOnly", chat_id) == "1"
+
+    async def set_audio_only(self, chat_id, enabled):
+        if enabled:
+            await self.redis.hset(f"{BOT_ID}:AudioOnly", chat_id, "1")
+        else:
+            await self.redis.hdel(f"{BOT_ID}:AudioOnly", chat_id)
+
+    async def clear_data(self, key):
+        datas = await self.extract(key)
+        if datas.get("path") and await self.redis.hincrby(self.media.refs_key, datas["path"], -1) <= 0:
+            await self.redis.hdel(self.media.refs_key, datas["path"])
+            self.trash.put_nowait(datas["path"])
+        if await self.redis.hincrby(self.holders_key, key, -1) > 0:
+            return
+        self.cache.drop(key)
+        pipe = self.redis.pipeline()
+        pipe.hdel(self.holders_key, key)
+        pipe.delete(self.pending_key(key))
+        pipe.delete(self.track_key(key))
+        pipe.publish(f"{BOT_ID}:TrackInvalidate", f"{self.origin}:{key}")
+        if datas.get("id"):
+            pipe.hdel(f"{BOT_ID}:InProgress", datas["id"])
+        await pipe.execute()
+
+    async def clear(self, chat_id):
+        self.cursors.pop(chat_id, None)
+        keys = [
+            self.queue_key(chat_id),
+            self.entries_key(chat_id),
+            self.shuffle_key(chat_id),
+            f"{BOT_ID}:QueueSeq:{chat_id}",
+            f"{BOT_ID}:NowPlaying",
+            f"{BOT_ID}:Status",
+            f"{BOT_ID}:PlayingRule",
+            f"{BOT_ID}:InProgress",
+            self.media.refs_key,
+            self.holders_key,
+        ]
+        args = [chat_id, self.track_key(""), f"{BOT_ID}:TrackInvalidate", self.origin, self.pending_key("")]
+        tracks, paths = await self.clear_script(keys=keys, args=args)
+        for key in tracks:
+            self.cache.drop(key)
+        for path in paths:
+            self.trash.put_nowait(path)
+
+    async def reap(self):
+        # Released media stays cached for other chats, eviction runs here off
+        # the handlers' path once files stop being referenced.
+        while True:
+            await self.trash.get()
+            while not self.trash.empty():
+                self.trash.get_nowait()
+            try:
+                await self.media.evict()
+            except Exception as e:
+                logging.error(f"Media eviction failed: {e}")
+
+    async def next(self, chat_id, force=False):
+        cursor = await self.cursor(chat_id)
+        current = cursor.entries.get(cursor.now)
+        total = len(cursor.keys)
+        rule = cursor.rule
+        index = cursor.index + 1
         if rule == "shuffle":
-            return random.choice(playlist)
+            if cursor.pointer + 1 >= len(cursor.order):
+                cursor.shuffle()
+                pipe = self.redis.pipeline()
+                self.save_shuffle(chat_id, cursor, pipe)
+                await pipe.execute()
+            return cursor.order[cursor.pointer + 1] if cursor.order else None
         if force:
-            if index == len(playlist):
+            if index == total:
                 if rule == "queue":
                     return None
                 index = 0
-            return playlist[index]
+            return await self.at(chat_id, index)
         if rule == "repeat-one":
             return current
         else:
-            if index == len(playlist):
+            if index == total:
                 if rule == "repeat":
                     index = 0
                 elif rule == "queue":
                     return None
-            return playlist[index]
+            return await self.at(chat_id, index)
 
-    def previous(self, chat_id):
-        current = self.get_full_form(chat_id, self.now(chat_id))
-        playlist = self.get(chat_id)
-        rule = self.rule(chat_id)
-        index = playlist.index(current) - 1
+    async def previous(self, chat_id):
+        cursor = await self.cursor(chat_id)
+        total = len(cursor.keys)
+        rule = cursor.rule
+        index = cursor.index - 1
         if rule == "shuffle":
-            return random.choice(playlist)
+            return cursor.order[cursor.pointer - 1] if cursor.pointer > 0 else None
         if index == -1:
             if rule != "repeat":
                 return None
-        return playlist[index]
+            index = total - 1
+        return await self.at(chat_id, index)
 
 
-playlist = Playlist(redis)
-rj = RadioJavan()
+media_cache = MediaCache(redis, quota=MEDIA_QUOTA)
+flights = SingleFlight(redis)
+search_cache = SearchCache(redis, SEARCH_CACHE_SIZE, SEARCH_TTL)
+playlist = Playlist(redis, media_cache, TRACK_CACHE_SIZE)
+rj = AsyncRadioJavan(RJ_BASE_URL, durations=DurationCache(redis))
+downloader = Downloader()
+covers = CoverCache(bot, CoverRenderer(bot), playlist.convert_seconds, quota=COVER_QUOTA)
 
 ############################### Start Utils ###############################
 
 
-def download_url(url, filename):
-    response = requests.get(url)
-    with open(filename, mode="wb") as file:
-        file.write(response.content)
-    return filename
+def download_progress(chat_id, message_id, text):
+    async def progress(done, total):
+        status = f"{done / 1048576:.1f}MB"
+        if total:
+            status = f"{done * 100 // total}% ({status} / {total / 1048576:.1f}MB)"
+        try:
+            await bot.edit_message_text(chat_id, message_id, text=f"{text}\n{status}")
+        except:
+            pass
+    return progress
+
+
+STREAM_READY_TIMEOUT = 3
+STREAM_RETRIES = 3
+STREAM_REJOIN_DELAY = 2
+STREAM_FAILED_TEXT = "⚏ پخش این موزیک با خطا مواجه شد، لطفا مجددا تلاش کنید ❗️"
+stream_stats = deque(maxlen=100)
+keyframe_indexes = {}
+transcodes = {}
+prefetchers = {}
+prefetch_sleeps = {}
+prefetched = {}
+INLINE_DEBOUNCE = 0.4
+inline_searches = {}
+inline_sequence = itertools.count()
+inline_stats = {"served": 0, "dropped": 0}
+
+
+async def fetch_search(query):
+    return await flights.do(f"search:{query}", lambda: rj.search(query))
+
+
+async def search(query):
+    return await search_cache.search(query, fetch_search)
+
+
+async def fetch_media(source, download):
+    path = await media_cache.lookup(source)
+    if path:
+        return path
+    async def job():
+        return await flights.leased(source, download, lambda: media_cache.lookup(source))
+    return await flights.do(source, job)
+
+
+async def download_track(track, progress=None):
+    if progress:
+        await progress(0, None)
+    if track["identifier"] == "telegram":
+        chat_id, message_id = track["id"].split("/")
+        msg = await bot.get_messages(int(chat_id), int(message_id))
+        media = getattr(msg, track["type"])
+        _, ext = os.path.splitext(media.file_name)
+        filename = hasher(f"{media.file_name}-{media.file_id}")
+        file_path = await msg.download(file_name=f"{filename}{ext}")
+    else:
+        _, ext = os.path.splitext(track["link"])
+        filename = hasher(f"{track['title']}-{track['id']}")
+        file_path = await downloader.download(track["link"], f"{filename}{ext}", progress=progress)
+    return await media_cache.store(track["source"], file_path)
+
+
+async def fetch_track(chat_id, key, progress=None):
+    track = await playlist.extract(key)
+    if not track:
+        return None
+    if not track.get("path"):
+        path = await fetch_media(track["source"], lambda: download_track(track, progress))
+        track = await playlist.resolve(key, path)
+    if track:
+        prepare_media(track, await playlist.audio_only(chat_id))
+        return track["path"]
+
+
+fetcher = FetchPool(fetch_track, DOWNLOAD_WORKERS, DOWNLOAD_PER_CHAT)
+
+
+async def ensure_track(chat_id, key, progress=None):
+    track = await playlist.extract(key)
+    if track and not track.get("path") and await fetcher.wait(chat_id, key, progress):
+        track = await playlist.extract(key)
+    return track if track and track.get("path") else None
+
+
+async def prepare_radiojavan(item_type, item_id):
+    source = f"radiojavan:{item_type}:{item_id}"
+    async def job():
+        if item_type == "video":
+            result = await rj.get_video(item_id)
+        else:
+            result = await rj.get_audio(item_id)
+        artwork = result.pop("thumbnail", None)
+        if artwork:
+            result["artwork"] = artwork
+        result["thumbnail"] = await cover(result["artist"], result["title"], type=item_type, duration=result.get("duration", None), thumbnail=artwork)
+        result["identifier"] = "radiojavan"
+        result["source"] = source
+        path = await media_cache.lookup(source)
+        if path:
+            result["path"] = path
+        return result
+    return dict(await flights.do(f"prepare:{source}", job))
+
+
+async def scan_media():
+    await asyncio.get_running_loop().run_in_executor(None, covers.scan)
+    await media_cache.scan()
+    async for key in redis.scan_iter(match=playlist.track_key("*"), count=500):
+        source, path = await redis.hmget(key, "source", "path")
+        if source and path:
+            await media_cache.index(source, path)
+    await media_cache.evict()
+
+
+async def migrate_playlists():
+    # Runs before the clients start, a handler loading a cursor mid migration
+    # would cache the chat's playlist as empty and an add() racing the
+    # recount would lose its holder.
+    await playlist.migrate_queues()
+    await playlist.count_holders()
 
 
-def extract_audio(path):
-    video = VideoFileClip(path) # 2.
-    audio = video.audio # 3.
-    # _, ext = os.path.splitext(path)
-    filename = f"audio_{path}"
-    audio.write_audiofile(filename)
-    return filename
+async def migrate_legacy_data():
+    while await playlist.migrate_legacy():
+        await asyncio.sleep(0.1)
+
 
 def get_active_calls():
     for chat in pytgcalls.active_calls:
@@ -284,7 +1333,7 @@ def authorized_groups(func):
             chat_id = message.message.chat.id
         else:
             chat_id = message.chat.id
-        if not redis.sismember(f"{BOT_ID}botgps", chat_id):
+        if not await redis.sismember(f"{BOT_ID}botgps", chat_id):
             return False
         return await func(client, message)
     return wrapper
@@ -295,22 +1344,22 @@ def authorized_users(func):
     async def wrapper(client, message):
         if isinstance(message, CallbackQuery):
             chat_id = message.message.chat.id
-            if redis.get(f"{BOT_ID}:Limit:{chat_id}:{message.from_user.id}"):
+            if await redis.get(f"{BOT_ID}:Limit:{chat_id}:{message.from_user.id}"):
                 message.answer("hhh", show_alert=True)
-            redis.setex(f"{BOT_ID}:Limit:{chat_id}:{message.from_user.id}", 2, "true")
+            await redis.setex(f"{BOT_ID}:Limit:{chat_id}:{message.from_user.id}", 2, "true")
         else:
             chat_id = message.chat.id
         if message.from_user.id in SUDO_RG:
             return await func(client, message)
         if message.from_user.id in SUDO_USERS:
             return await func(client, message)
-        if redis.sismember(f"{BOT_ID}sudo:", message.from_user.id):
+        if await redis.sismember(f"{BOT_ID}sudo:", message.from_user.id):
             return await func(client, message)
-        if redis.sismember(f"{BOT_ID}owners:{chat_id}", message.from_user.id):
+        if await redis.sismember(f"{BOT_ID}owners:{chat_id}", message.from_user.id):
             return await func(client, message)
-        if redis.sismember(f"{BOT_ID}owner:{chat_id}", message.from_user.id):
+        if await redis.sismember(f"{BOT_ID}owner:{chat_id}", message.from_user.id):
             return await func(client, message)
-        if redis.sismember(f"{BOT_ID}mods:{chat_id}", message.from_user.id):
+        if await redis.sismember(f"{BOT_ID}mods:{chat_id}", message.from_user.id):
             return await func(client, message)
         return False
     return wrapper
@@ -325,71 +1374,22 @@ def has_active_call(func):
     return wrapper
 
 
-def change_image_size(maxWidth, maxHeight, image):
-    widthRatio = maxWidth / image.size[0]
-    heightRatio = maxHeight / image.size[1]
-    newWidth = int(widthRatio * image.size[0])
-    newHeight = int(heightRatio * image.size[1])
-    newImage = image.resize((newWidth, newHeight))
-    return newImage
-
-
 def hasher(name):
     return hashlib.md5(name.encode()).hexdigest()
 
 
 async def cover(artist, title, type="audio", duration=None, thumbnail=None):
-    file_name = f"{artist}-{title}-{type}-{duration}-{thumbnail}"
-    file_unique_name = hasher(file_name)
-    filename = f"covers/{file_unique_name}.png"
-    if os.path.exists(filename):
-        return filename
-    thumb_name = f"covers/{file_unique_name}-thumb.png"
-    temp_name = f"covers/{file_unique_name}-temp.png"
-    if not os.path.exists("covers"):
-        os.makedirs("covers")
-    if thumbnail:
-        if os.path.exists(thumbnail):
-            shutil.copyfile(thumbnail, thumb_name)
-        else:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(thumbnail) as resp:
-                    if resp.status == 200:
-                        f = await aiofiles.open(thumb_name, mode="wb")
-                        await f.write(await resp.read())
-                        await f.close()
-        image1 = Image.open(thumb_name)
-        image2 = Image.open("files/foreground.png")
-        image3 = change_image_size(1280, 720, image1)
-        image4 = change_image_size(1280, 720, image2)
-        image5 = image3.convert("RGBA")
-        image6 = image4.convert("RGBA")
-        Image.alpha_composite(image5, image6).save(temp_name)
-        img = Image.open(temp_name)
-    else:
-        image1 = Image.open("files/foreground.png")
-        image2 = change_image_size(1280, 720, image1)
-        img = image2.convert("RGBA")
-    draw = ImageDraw.Draw(img)
-    font = ImageFont.truetype("files/font.otf", 32)
-    draw.text((205, 550), f"Artist: {artist}", (51, 215, 255), font=font)
-    draw.text((205, 590), f"Title: {title}", (51, 215, 255), font=font)
-    me = await bot.get_me()
-    if duration:
-        duration = playlist.convert_seconds(duration)
-        draw.text((205, 630), f"Duration: {duration}", (255, 255, 255), font=font)
-        draw.text((205, 670), f"By: @{me.username}", (255, 255, 255), font=font)
-    else:
-        draw.text((205, 630), f"By: @{me.username}", (255, 255, 255), font=font)
-    # draw.text((205, 630), f"Views: {views}", (255, 255, 255), font=font)
-    # draw.text((205, 630), f"Added By: {requested_by}", (255, 255, 255), font=font) # 670
-    img.save(filename)
-    try:
-        os.remove(temp_name)
-        os.remove(thumb_name)
-    except:
-        pass
-    return filename
+    return await covers.get(artist, title, type=type, duration=duration, artwork=thumbnail)
+
+
+async def track_cover(meta_data):
+    # The cover a track was saved with may have been evicted since, draw it
+    # again from what the track remembers.
+    if os.path.exists(meta_data["thumbnail"]):
+        if os.path.dirname(meta_data["thumbnail"]) == covers.directory:
+            os.utime(meta_data["thumbnail"])
+        return meta_data["thumbnail"]
+    return await cover(meta_data.get("artist", ""), meta_data.get("title", ""), type=meta_data["type"], duration=meta_data.get("duration"), thumbnail=meta_data.get("artwork"))
 
 
 async def prepare_helper(chat_id, message_id, callback=False):
@@ -431,26 +1431,19 @@ async def prepare_helper(chat_id, message_id, callback=False):
             return False
         except errors.UserAlreadyParticipant:
             pass
-    if playlist.now(chat_id):
-        redis.sadd(f"{BOT_ID}:CliGroups", chat_id)
+    if await playlist.now(chat_id):
+        await redis.sadd(f"{BOT_ID}:CliGroups", chat_id)
         return True
     if callback:
         await bot.edit_message_caption(chat_id, message_id, caption="✅ ربات دستیار آماده شد ✅")
     else:
         await bot.send_message(chat_id, "✅ ربات دستیار آماده شد ✅", reply_to_message_id=message_id)
-    redis.sadd(f"{BOT_ID}:CliGroups", chat_id)
+    await redis.sadd(f"{BOT_ID}:CliGroups", chat_id)
     return True
 
 
-def save_to(directiory, path):
-    if not os.path.exists(directiory):
-        os.makedirs(directiory)
-    filename = f"{directiory}/{os.path.basename(path)}"
-    os.rename(path, filename)
-    return filename
-
-
 async def leave_group_call(chat_id):
+    cancel_prefetch(chat_id)
     try:
         await pytgcalls.leave_group_call(chat_id)
     except:
@@ -464,30 +1457,233 @@ async def join_group_call(chat_id, stream):
         pass
 
 
-async def change_stream(chat_id, key, seek=None, new=False):
+async def probe_keyframes(path):
+    process = await asyncio.create_subprocess_exec(
+        "ffprobe", "-v", "error", "-select_streams", "v:0",
+        "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", path,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+    stdout, _ = await process.communicate()
+    if process.returncode != 0:
+        return None
+    keyframes = []
+    for line in stdout.decode().splitlines():
+        pts, _, flags = line.partition(",")
+        if "K" in flags:
+            try:
+                keyframes.append(float(pts))
+            except ValueError:
+                continue
+    return sorted(keyframes)
+
+
+async def keyframe_index(path):
+    if path in keyframe_indexes:
+        return keyframe_indexes[path]
+    index_path = f"{path}.idx"
+    if os.path.exists(index_path):
+        async with aiofiles.open(index_path, mode="r") as f:
+            keyframes = [float(line) for line in (await f.read()).split()]
+    else:
+        keyframes = await probe_keyframes(path)
+        if keyframes is None:
+            return []
+        async with aiofiles.open(index_path, mode="w") as f:
+            await f.write("\n".join(map(str, keyframes)))
+    keyframe_indexes[path] = keyframes
+    return keyframes
+
+
+async def seek_point(meta_data, target):
+    # Every audio packet is a sync point, video has to start on a keyframe or
+    # the audio and video decoders end up at different positions.
+    if meta_data["type"] != "video":
+        return int(target)
+    keyframes = await keyframe_index(meta_data["path"])
+    i = bisect.bisect_right(keyframes, target)
+    return keyframes[i - 1] if i else int(target)
+
+
+def pcm_path(path):
+    return f"pcm/{os.path.basename(path)}.raw"
+
+
+def demux_path(path):
+    return f"demux/{os.path.basename(path)}.m4a"
+
+
+async def ffmpeg_into(path, target, *args, source=None):
+    # Output goes to a .part file and is only renamed into place when ffmpeg
+    # succeeds, so a target that exists is always complete. source is read
+    # instead of path when an intermediate file already holds what is needed.
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-y", "-v", "error", "-i", source or path, *args, f"{target}.part",
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    await process.wait()
+    if process.returncode != 0:
+        logging.error(f"Could not convert {source or path} into {target}")
+        if os.path.exists(f"{target}.part"):
+            os.remove(f"{target}.part")
+        return None
+    os.replace(f"{target}.part", target)
+    await media_cache.account(path)
+    return target
+
+
+async def transcode(path, source=None):
+    # Decode once into exactly what the call consumes (PCM16LE, mono, at the
+    # stream bitrate) so replays are a plain file read instead of an ffmpeg run.
+    return await ffmpeg_into(path, pcm_path(path), "-vn", "-f", "s16le", "-ac", "1", "-ar", str(MediumQualityAudio().bitrate), source=source)
+
+
+async def extract_audio(path):
+    # Copy the audio stream out of the video container as is, nothing gets
+    # re-encoded.
+    return await ffmpeg_into(path, demux_path(path), "-vn", "-acodec", "copy", "-f", "ipod")
+
+
+async def transcode_audio_only(path):
+    # The demuxed copy serves seeks and the wait for the PCM, which is then
+    # decoded from that copy instead of the whole video container again.
+    demuxed = demux_path(path) if os.path.exists(demux_path(path)) else await extract_audio(path)
+    return await transcode(path, source=demuxed)
+
+
+def convert_in_background(target, job):
+    if target not in transcodes and not os.path.exists(target):
+        transcodes[target] = asyncio.ensure_future(job())
+        transcodes[target].add_done_callback(lambda _: transcodes.pop(target, None))
+
+
+def prepare_media(meta_data, audio_only=False):
+    path = meta_data["path"]
+    if meta_data["type"] == "video":
+        asyncio.ensure_future(keyframe_index(path))
+        if audio_only:
+            convert_in_background(pcm_path(path), lambda: transcode_audio_only(path))
+        return
+    convert_in_background(pcm_path(path), lambda: transcode(path))
+
+
+def build_stream(meta_data, seek=None, audio_only=False):
+    path = meta_data["path"]
+    video = meta_data["type"] == "video" and not audio_only
+    if not video and not seek and os.path.exists(pcm_path(path)):
+        return InputStream(InputAudioStream(pcm_path(path), MediumQualityAudio()))
+    parameters = ""
+    if seek:
+        parameters = "-noaccurate_seek -ss {}".format(seek)
+    if video:
+        return AudioVideoPiped(path, MediumQualityAudio(), MediumQualityVideo(), additional_ffmpeg_parameters=parameters)
+    if meta_data["type"] == "video" and os.path.exists(demux_path(path)):
+        path = demux_path(path)
+    return AudioPiped(path, MediumQualityAudio(), additional_ffmpeg_parameters=parameters)
+
+
+async def wait_stream_ready(chat_id, timeout=STREAM_READY_TIMEOUT, interval=0.2):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        await asyncio.sleep(interval)
+        try:
+            if await pytgcalls.played_time(chat_id):
+                return True
+        except (tgerrors.NotInGroupCallError, tgerrors.NoActiveGroupCall):
+            pass
+    return False
+
+
+async def prefetch(chat_id, key):
+    # Sleep until the current track is about to end, then get the next one
+    # ready so on_stream_end only has to swap streams. Only the sleep is ever
+    # cancelled, the rest awaits Redis, so a prefetch that was superseded
+    # meanwhile runs to the end and throws away what it prepared.
+    current = asyncio.current_task()
+    _, _id = playlist.split_key(key)
+    meta_data = await playlist.extract(_id)
+    try:
+        played = await pytgcalls.played_time(chat_id)
+    except (tgerrors.NotInGroupCallError, tgerrors.NoActiveGroupCall):
+        return
+    if prefetchers.get(chat_id) is not current:
+        return
+    remaining = float(meta_data.get("duration") or 0) - playlist.offset(meta_data) - played
+    sleep = prefetch_sleeps[current] = asyncio.ensure_future(asyncio.sleep(max(0, remaining - PREFETCH_SECONDS)))
+    try:
+        await asyncio.wait([sleep])
+    finally:
+        prefetch_sleeps.pop(current, None)
+    if prefetchers.get(chat_id) is not current or await playlist.now(chat_id) != _id:
+        return
+    next_key = await playlist.next(chat_id)
+    if not next_key:
+        return
+    _, next_id = playlist.split_key(next_key)
+    next_data = await ensure_track(chat_id, next_id)
+    if not next_data or not os.path.exists(next_data["path"]):
+        return
+    audio_only = await playlist.audio_only(chat_id)
+    prepare_media(next_data, audio_only)
+    if pcm_path(next_data["path"]) in transcodes:
+        await asyncio.shield(transcodes[pcm_path(next_data["path"])])
+    if prefetchers.get(chat_id) is current:
+        prefetched[chat_id] = (next_key, build_stream(next_data, audio_only=audio_only))
+
+
+def schedule_prefetch(chat_id, key):
+    cancel_prefetch(chat_id)
+    prefetchers[chat_id] = asyncio.ensure_future(prefetch(chat_id, key))
+
+
+def cancel_prefetch(chat_id):
+    sleep = prefetch_sleeps.pop(prefetchers.pop(chat_id, None), None)
+    if sleep:
+        sleep.cancel()
+    prefetched.pop(chat_id, None)
+
+
+async def change_stream(chat_id, key, seek=None, new=False, retries=STREAM_RETRIES):
+    started = time.monotonic()
+    prepared_key, prepared = prefetched.get(chat_id, (None, None))
+    cancel_prefetch(chat_id)
+    if seek or prepared_key != key:
+        prepared = None
     _, _id = playlist.split_key(key)
-    playlist.play(chat_id, _id)
-    meta_data = playlist.extract(_id)
+    meta_data = await ensure_track(chat_id, _id)
+    if not meta_data:
+        stream_stats.append(None)
+        logging.error(f"Track {_id} for {chat_id} could not be fetched")
+        return False
+    await playlist.play(chat_id, _id)
     if not seek and meta_data.get("seek"):
         del meta_data["seek"]
-        playlist.compress(meta_data)
-    stream = AudioPiped(meta_data["path"], MediumQualityAudio())
-    if seek:
-        stream = AudioPiped(meta_data["path"], MediumQualityAudio(), additional_ffmpeg_parameters="-ss {} -to {}".format(seek, meta_data["duration"]))
-    if meta_data["type"] == "video":
-        stream = AudioVideoPiped(meta_data["path"], MediumQualityAudio(), MediumQualityVideo())
-        if seek:
-            stream = AudioVideoPiped(meta_data["path"], MediumQualityAudio(), MediumQualityVideo(), additional_ffmpeg_parameters="-ss {} -to {}".format(seek, meta_data["duration"]))
-    if new:
-        await leave_group_call(chat_id)
-        time.sleep(2)
-        await join_group_call(chat_id, stream)
-    else:
-        await pytgcalls.change_stream(chat_id, stream)
-    time.sleep(1)
-    played_seconds = await pytgcalls.played_time(chat_id)
-    if played_seconds == 0:
-        return await change_stream(chat_id, key, seek=2)
+        await playlist.compress(meta_data)
+    audio_only = await playlist.audio_only(chat_id)
+    prepare_media(meta_data, audio_only)
+    await media_cache.touch(meta_data["path"])
+    # A prepared stream replaces the finished one in place, only a cold start
+    # needs the leave and rejoin.
+    new = new and prepared is None
+    for attempt in range(1, retries + 1):
+        stream, prepared = prepared or build_stream(meta_data, seek, audio_only), None
+        if new:
+            await leave_group_call(chat_id)
+            await asyncio.sleep(STREAM_REJOIN_DELAY)
+            await join_group_call(chat_id, stream)
+        else:
+            await pytgcalls.change_stream(chat_id, stream)
+        if await wait_stream_ready(chat_id):
+            stream_stats.append(time.monotonic() - started)
+            if seek:
+                meta_data["seek"] = seek
+                await playlist.compress(meta_data)
+            schedule_prefetch(chat_id, key)
+            return True
+        # A stream that never reports progress is restarted a little past the
+        # beginning, which is what unsticks ffmpeg in practice.
+        seek, new = seek or 2, False
+        await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+    stream_stats.append(None)
+    logging.error(f"Stream for {chat_id} did not start after {retries} attempts ({time.monotonic() - started:.1f}s)")
+    return False
 
 
 async def get_current_volume(chat_id):
@@ -499,20 +1695,20 @@ async def get_current_volume(chat_id):
 
 
 async def delete_last_player(chat_id):
-    last_player = redis.hget(f"{BOT_ID}:PlayerMessage", chat_id) or None
+    last_player = await redis.hget(f"{BOT_ID}:PlayerMessage", chat_id) or None
     if last_player:
         try:
             await bot.delete_messages(chat_id, int(last_player))
         except:
-            redis.hdel(f"{BOT_ID}:PlayerMessage", chat_id)
+            await redis.hdel(f"{BOT_ID}:PlayerMessage", chat_id)
 
 
 async def prepare_player(chat_id):
-    _, first = playlist.split_key(playlist.get(chat_id)[0])
-    now_playing = playlist.now(chat_id)
-    meta_data = playlist.extract(now_playing)
-    thumbnail = meta_data["thumbnail"]
-    rule = playlist.rule(chat_id)
+    _, first = playlist.split_key(await playlist.first(chat_id))
+    now_playing = await playlist.now(chat_id)
+    meta_data = await playlist.extract(now_playing)
+    thumbnail = await track_cover(meta_data)
+    rule = await playlist.rule(chat_id)
     rule_text = ""
     if rule == "queue":
         rule_text = "➡️"
@@ -522,7 +1718,7 @@ async def prepare_player(chat_id):
         rule_text = "🔂"
     elif rule == "shuffle":
         rule_text = "🔀"
-    status = playlist.status(chat_id)
+    status = await playlist.status(chat_id)
     status_text = ""
     if status == "play":
         status_text = "⏸"
@@ -561,33 +1757,26 @@ async def prepare_player(chat_id):
 
 
 async def edit_player(chat_id, key):
-    last_player = redis.hget(f"{BOT_ID}:PlayerMessage", chat_id) or None
+    last_player = await redis.hget(f"{BOT_ID}:PlayerMessage", chat_id) or None
     if last_player:
         try:
             _, _id = playlist.split_key(key)
             thumb, markup = await prepare_player(chat_id)
-            await bot.edit_message_media(chat_id, int(last_player), InputMediaPhoto(thumb, caption=playlist.display(_id)), reply_markup=markup)
+            await bot.edit_message_media(chat_id, int(last_player), InputMediaPhoto(thumb, caption=await playlist.display(_id)), reply_markup=markup)
         except:
             pass
 
 
-def chunks(lst, n):
-    return [lst[i:i + n] for i in range(0, len(lst), n)]
-
-
 async def prepare_playlist(chat_id, page=0):
-    plylist = playlist.get(chat_id)
-    plist = chunks(plylist, 10)
+    pages, items = await playlist.page(chat_id, page)
     rows = []
-    for item in plist[page]:
-        _pos, _id = playlist.split_key(item)
-        name = f"#{plylist.index(item)+1} : {playlist.get_name(_id)}"
-        rows.append([InlineKeyboardButton(name, f"playforce-{_id}"), InlineKeyboardButton("❌", f"delete-{_id}")])
-    if page == 0 and len(plist) > 1:
+    for possition, _id, name in items:
+        rows.append([InlineKeyboardButton(f"#{possition} : {name}", f"playforce-{_id}"), InlineKeyboardButton("❌", f"delete-{_id}")])
+    if page == 0 and pages > 1:
         rows.append([InlineKeyboardButton("صفحه بعد ⏭", f"playlist-{page+1}")])
-    elif page > 0 and page == len(plist)-1:
+    elif page > 0 and page == pages-1:
         rows.append([InlineKeyboardButton("⏮ صفحه قبل", f"playlist-{page-1}")])
-    elif page > 0 and page < len(plist)-1:
+    elif page > 0 and page < pages-1:
         rows.append([InlineKeyboardButton("⏮ صفحه قبل", f"playlist-{page-1}"), InlineKeyboardButton("صفحه بعد ⏭", f"playlist-{page+1}")])
     rows.append([InlineKeyboardButton("🔙 بازگشت", "back"), InlineKeyboardButton("❌ بستن", "close")])
     markup = InlineKeyboardMarkup(rows)
@@ -604,15 +1793,33 @@ async def inline(client, query):
     if search_query == "":
         await bot.answer_inline_query(query.id, results=answers, switch_pm_text="نام یک آهنگ را بنویسید ...", switch_pm_parameter="inline", cache_time=0)
     else:
-        for result in rj.search(search_query):
+        # Every keystroke is a new inline query. Only the newest one per user
+        # is worth answering, so each waits out a short debounce and gives up
+        # once the same user has typed something newer. Nothing is cancelled,
+        # a search interrupted mid Redis command would leave its reply on a
+        # pooled connection.
+        user_id = query.from_user.id
+        sequence = inline_searches[user_id] = next(inline_sequence)
+        await asyncio.sleep(INLINE_DEBOUNCE)
+        if inline_searches.get(user_id) == sequence:
+            results, narrowed = await search_cache.lookup(search_query, fetch_search, prefix=True)
+        if inline_searches.get(user_id) != sequence:
+            inline_stats["dropped"] += 1
+            return
+        del inline_searches[user_id]
+        inline_stats["served"] += 1
+        # Telegram caches an answer for everyone typing the same text, a
+        # narrowed subset must not stand in for the real results that long.
+        cache_time = 0 if narrowed else SEARCH_TTL
+        for result in results:
             if result["type"] == "audio":
                 answers.append(InlineQueryResultAudio(audio_url=result["link"], title=f'🎵 {result["artist"]} - {result["title"]}'))
         try:
-            await query.answer(results=answers, cache_time=0)
+            await query.answer(results=answers, cache_time=cache_time)
         except errors.QueryIdInvalid:
             await query.answer(results=answers, cache_time=0, switch_pm_text="لطفا مجددا تلاش کنید.", switch_pm_parameter="")
         except errors.ResultsTooMuch:
-            await query.answer(results=answers[:20], cache_time=0)
+            await query.answer(results=answers[:20], cache_time=cache_time)
 
 ############################### End Inline ###############################
 
@@ -620,10 +1827,10 @@ async def inline(client, query):
 
 @cli.on_message(filters.text & filters.private & ~filters.me & ~filters.bot)
 async def permit(client, message):
-    if not redis.smembers(f"{BOT_ID}:CliAlerts", message.from_user.id):
+    if not await redis.smembers(f"{BOT_ID}:CliAlerts", message.from_user.id):
         api = await bot.get_me()
         await message.reply(message.chat.id, f"❗️ این ربات، دستیار وویس چت ربات زیر میباشد و استفاده دیگری ندارد ❗️\n@{api.username}\n❗️ لطفا از پیام دادن مجدد خودداری کنید، جوابی دریافت خواهید کرد ❗️")
-        redis.sadd(f"{BOT_ID}:CliAlerts", message.from_user.id)
+        await redis.sadd(f"{BOT_ID}:CliAlerts", message.from_user.id)
 
 ############################### End Cli Private Permit ###############################
 
@@ -631,30 +1838,38 @@ async def permit(client, message):
 
 @pytgcalls.on_stream_end()
 async def on_stream_end(client, message):
-    if not playlist.next(message.chat_id):
-        await delete_last_player(message.chat_id)
-        playlist.clear(message.chat_id)
-        await leave_group_call(message.chat_id)
-    else:
-        key = playlist.next(message.chat_id)
-        now = playlist.get_full_form(message.chat_id, playlist.now(message.chat_id))
-        if key == now:
-            await change_stream(message.chat_id, key, new=True)
-        else:
-            await change_stream(message.chat_id, key)
-        await edit_player(message.chat_id, key)
+    # A track that cannot be fetched or started is skipped, each entry gets
+    # one try before the call is given up.
+    key = await playlist.next(message.chat_id)
+    failed = False
+    for _ in range(await playlist.count(message.chat_id)):
+        if not key:
+            break
+        now = await playlist.get_full_form(message.chat_id, await playlist.now(message.chat_id))
+        if await change_stream(message.chat_id, key, new=key == now):
+            return await edit_player(message.chat_id, key)
+        failed = True
+        await playlist.play(message.chat_id, playlist.split_key(key)[1])
+        key = await playlist.next(message.chat_id, force=True)
+    await delete_last_player(message.chat_id)
+    await playlist.clear(message.chat_id)
+    await leave_group_call(message.chat_id)
+    if failed:
+        await bot.send_message(message.chat_id, "⚏ پخش موزیک های باقی مانده با خطا مواجه شد و پخش زنده متوقف شد ❗️")
 
 
 @pytgcalls.on_kicked()
 async def clean_playlist_on_kicked(client, chat_id):
-    playlist.clear(chat_id)
-    redis.srem(f"{BOT_ID}:CliGroups", chat_id)
+    cancel_prefetch(chat_id)
+    await playlist.clear(chat_id)
+    await redis.srem(f"{BOT_ID}:CliGroups", chat_id)
 
 
 @pytgcalls.on_closed_voice_chat()
 async def clean_playlist_on_close(client, chat_id):
-    playlist.clear(chat_id)
-    redis.srem(f"{BOT_ID}:CliGroups", chat_id)
+    cancel_prefetch(chat_id)
+    await playlist.clear(chat_id)
+    await redis.srem(f"{BOT_ID}:CliGroups", chat_id)
     await delete_last_player(chat_id)
 
 ############################### End Voice Chat Manager ###############################
@@ -667,7 +1882,7 @@ async def clean_playlist_on_close(client, chat_id):
 @authorized_users
 @has_active_call
 async def show_playlist(client, message):
-    if not playlist.now(message.chat.id):
+    if not await playlist.now(message.chat.id):
         return await message.reply("🚫 لیست پخش شما خالی است 🚫")
     await delete_last_player(message.chat.id)
     markup = await prepare_playlist(message.chat.id)
@@ -679,22 +1894,39 @@ async def show_playlist(client, message):
 @authorized_users
 @has_active_call
 async def pause(client, message):
-    if playlist.status(message.chat.id) == "play":
+    if await playlist.status(message.chat.id) == "play":
         await pytgcalls.pause_stream(message.chat.id)
-        playlist.pause(message.chat.id)
+        await playlist.pause(message.chat.id)
         await message.reply("⚏ پخش زنده با موفقیت متوقف شد .")
     else:
         await message.reply("⚏ پخش زنده متوقف بود.")
 
 
+@bot.on_message(filters.regex("^\/(audioonly)$") | filters.regex("^(فقط صدا)$") & filters.group)
+@authorized_groups
+@authorized_users
+async def toggle_audio_only(client, message):
+    enabled = not await playlist.audio_only(message.chat.id)
+    await playlist.set_audio_only(message.chat.id, enabled)
+    await message.reply(f"⚏ پخش فقط صدای موزیک ویدئوها {'فعال' if enabled else 'غیرفعال'} شد .")
+    now_playing = await playlist.now(message.chat.id)
+    if not now_playing or message.chat.id not in get_active_calls():
+        return
+    meta_data = await playlist.extract(now_playing)
+    if meta_data.get("type") == "video":
+        played_seconds = await pytgcalls.played_time(message.chat.id) + playlist.offset(meta_data)
+        if not await change_stream(message.chat.id, await playlist.get_full_form(message.chat.id, now_playing), seek=await seek_point(meta_data, played_seconds)):
+            await message.reply(STREAM_FAILED_TEXT)
+
+
 @bot.on_message(filters.regex("^\/(resume)$") | filters.regex("^(ادامه)$") & filters.group)
 @authorized_groups
 @authorized_users
 @has_active_call
 async def resume(client, message):
-    if playlist.status(message.chat.id) == "pause":
+    if await playlist.status(message.chat.id) == "pause":
         await pytgcalls.resume_stream(message.chat.id)
-        playlist.resume(message.chat.id)
+        await playlist.resume(message.chat.id)
         await message.reply("⚏ پخش زنده از سر گرفته شد .")
     else:
         await message.reply("⚏ پخش زنده در حال اجرا بود.")
@@ -705,14 +1937,14 @@ async def resume(client, message):
 @authorized_users
 @has_active_call
 async def stop(client, message):
-    last_player = redis.hget(f"{BOT_ID}:PlayerMessage", message.chat.id) or None
+    last_player = await redis.hget(f"{BOT_ID}:PlayerMessage", message.chat.id) or None
     if last_player:
         try:
             await bot.delete_messages(message.chat.id, int(last_player))
         except:
-            redis.hdel(f"{BOT_ID}:PlayerMessage", message.chat.id)
+            await redis.hdel(f"{BOT_ID}:PlayerMessage", message.chat.id)
     await leave_group_call(message.chat.id)
-    playlist.clear(message.chat.id)
+    await playlist.clear(message.chat.id)
     await message.reply("⚏ پخش زنده با موفقیت متوقف شد .")
 
 
@@ -721,31 +1953,31 @@ async def stop(client, message):
 @authorized_users
 @has_active_call
 async def download_current(client, message):
-    now_playing = playlist.now(message.chat.id)
-    meta_data = playlist.extract(now_playing)
+    now_playing = await playlist.now(message.chat.id)
+    meta_data = await playlist.extract(now_playing)
     if meta_data["identifier"] == "radiojavan":
         size = os.stat(meta_data["path"])
         size = size.st_size // (1024 * 1024)
         if size <= 20:
-            if not redis.hget(f"{BOT_ID}:MessageID", meta_data["id"]):
-                if not redis.sismember(f"{BOT_ID}:Saved", meta_data["id"]):
-                    if redis.hget(f"{BOT_ID}:InProgress", meta_data["id"]):
+            if not await redis.hget(f"{BOT_ID}:MessageID", meta_data["id"]):
+                if not await redis.sismember(f"{BOT_ID}:Saved", meta_data["id"]):
+                    if await redis.hget(f"{BOT_ID}:InProgress", meta_data["id"]):
                         return await bot.send_message(message.chat.id, "⚏ این فایل د رحال آپلود می باشد ...", reply_to_message_id=message.id)
                     m = await bot.send_message(message.chat.id, "⚏ آپلود فایل آغاز شد ...", reply_to_message_id=message.id)
-                    redis.hset(f"{BOT_ID}:InProgress", meta_data["id"], "true")
+                    await redis.hset(f"{BOT_ID}:InProgress", meta_data["id"], "true")
                     if meta_data["type"] == "video":
                         vid = cv2.VideoCapture(meta_data["path"])
                         height = vid.get(cv2.CAP_PROP_FRAME_HEIGHT)
                         width = vid.get(cv2.CAP_PROP_FRAME_WIDTH)
                         _, ext = os.path.splitext(meta_data["path"])
-                        msg = await bot.send_video(DATABASE_CHANNEL, open(meta_data["path"], "rb"), file_name=f"{meta_data['title']}{ext}", height=math.ceil(height), width=math.ceil(width), duration=int(meta_data["duration"]), thumb=open(meta_data["thumbnail"], "rb"))
+                        msg = await bot.send_video(DATABASE_CHANNEL, open(meta_data["path"], "rb"), file_name=f"{meta_data['title']}{ext}", height=math.ceil(height), width=math.ceil(width), duration=int(meta_data["duration"]), thumb=open(await track_cover(meta_data), "rb"))
                     else:
                         msg = await bot.send_audio(DATABASE_CHANNEL, open(meta_data["path"], "rb"), file_name=f"{meta_data['title']}{ext}", performer=meta_data["artist"], title=meta_data["title"])
-                    redis.hdel(f"{BOT_ID}:InProgress", meta_data["id"])
-                    redis.sadd(f"{BOT_ID}:Saved", meta_data["id"])
-                    redis.hset(f"{BOT_ID}:MessageID", meta_data["id"], msg.id)
+                    await redis.hdel(f"{BOT_ID}:InProgress", meta_data["id"])
+                    await redis.sadd(f"{BOT_ID}:Saved", meta_data["id"])
+                    await redis.hset(f"{BOT_ID}:MessageID", meta_data["id"], msg.id)
                     await m.delete()
-            msg_id = redis.hget(f"{BOT_ID}:MessageID", meta_data["id"])
+            msg_id = await redis.hget(f"{BOT_ID}:MessageID", meta_data["id"])
             return await bot.copy_message(message.chat.id, DATABASE_CHANNEL, int(msg_id))
         else:
             txt = ""
@@ -769,17 +2001,18 @@ async def download_current(client, message):
 @authorized_users
 @has_active_call
 async def next(client, message):
-    if not playlist.next(message.chat.id):
+    if not await playlist.next(message.chat.id):
         return await message.reply("⚏ موزیک بعدی در لیست پخش وجود ندارد .")
-    key = playlist.next(message.chat.id, force=True)
-    now = playlist.now(message.chat.id)
-    await change_stream(message.chat.id, key)
+    key = await playlist.next(message.chat.id, force=True)
+    now = await playlist.now(message.chat.id)
+    if not await change_stream(message.chat.id, key):
+        return await message.reply(STREAM_FAILED_TEXT)
     _, _id = playlist.split_key(key)
-    meta_data = playlist.extract(_id)
+    meta_data = await playlist.extract(_id)
     await delete_last_player(message.chat.id)
     thumb, markup = await prepare_player(message.chat.id)
-    player = await message.reply_photo(meta_data["thumbnail"], caption=playlist.display(_id), reply_markup=markup)
-    redis.hset(f"{BOT_ID}:PlayerMessage", message.chat.id, player.id)
+    player = await message.reply_photo(await track_cover(meta_data), caption=await playlist.display(_id), reply_markup=markup)
+    await redis.hset(f"{BOT_ID}:PlayerMessage", message.chat.id, player.id)
 
 
 @bot.on_message(filters.regex("^\/(previous)$") | filters.regex("^(قبلی)$") & filters.group)
@@ -787,16 +2020,17 @@ async def next(client, message):
 @authorized_users
 @has_active_call
 async def previous(client, message):
-    if not playlist.previous(message.chat.id):
+    if not await playlist.previous(message.chat.id):
         return await message.reply("⚏ موزیک قبلی در لیست پخش وجود ندارد .")
-    key = playlist.previous(message.chat.id)
-    await change_stream(message.chat.id, key)
+    key = await playlist.previous(message.chat.id)
+    if not await change_stream(message.chat.id, key):
+        return await message.reply(STREAM_FAILED_TEXT)
     _, _id = playlist.split_key(key)
-    meta_data = playlist.extract(_id)
+    meta_data = await playlist.extract(_id)
     await delete_last_player(message.chat.id)
     thumb, markup = await prepare_player(message.chat.id)
-    player = await message.reply_photo(meta_data["thumbnail"], caption=playlist.display(_id), reply_markup=markup)
-    redis.hset(f"{BOT_ID}:PlayerMessage", message.chat.id, player.id)
+    player = await message.reply_photo(await track_cover(meta_data), caption=await playlist.display(_id), reply_markup=markup)
+    await redis.hset(f"{BOT_ID}:PlayerMessage", message.chat.id, player.id)
 
 
 @bot.on_message(filters.regex("^\/(player)$") | filters.regex("^(پلیر)$") & filters.group)
@@ -804,13 +2038,13 @@ async def previous(client, message):
 @authorized_users
 @has_active_call
 async def player(client, message):
-    if not playlist.now(message.chat.id):
+    if not await playlist.now(message.chat.id):
         return await message.reply("⚏ ویس چت در گروه فعال نیست ، ویس چت فعال کنید مجدد امتحان کنید !")
     await delete_last_player(message.chat.id)
     thumbnail, markup = await prepare_player(message.chat.id)
     played_seconds = await pytgcalls.played_time(message.chat.id)
-    player = await message.reply_photo(thumbnail, caption=playlist.display(playlist.now(message.chat.id), played_time=played_seconds), reply_markup=markup)
-    redis.hset(f"{BOT_ID}:PlayerMessage", message.chat.id, player.id)
+    player = await message.reply_photo(thumbnail, caption=await playlist.display(await playlist.now(message.chat.id), played_time=played_seconds), reply_markup=markup)
+    await redis.hset(f"{BOT_ID}:PlayerMessage", message.chat.id, player.id)
 
 
 @bot.on_message(filters.regex(r"^/(seek)\s(\+|\-)\s(\d+)$") & filters.group)
@@ -818,15 +2052,14 @@ async def player(client, message):
 @authorized_users
 @has_active_call
 async def seek(client, message):
-    if not playlist.now(message.chat.id):
+    if not await playlist.now(message.chat.id):
         return await message.reply("⚏ ویس چت در گروه فعال نیست ، ویس چت فعال کنید مجدد امتحان کنید !")
     op = re.match(r"^\/(seek)\s(\+|\-)\s(\d+)$", message.text, re.M|re.I).group(2)
     num = int(re.match(r"^\/(seek)\s(\+|\-)\s(\d+)$", message.text, re.M|re.I).group(3))
     played_seconds = await pytgcalls.played_time(message.chat.id)
-    now_playing = playlist.now(message.chat.id)
-    meta_data = playlist.extract(now_playing)
-    if meta_data.get("seek"):
-        played_seconds += eval(meta_data["seek"])
+    now_playing = await playlist.now(message.chat.id)
+    meta_data = await playlist.extract(now_playing)
+    played_seconds += playlist.offset(meta_data)
     if op == "+":
         to_seek = played_seconds + num
         if int(meta_data["duration"]) - to_seek <= 10:
@@ -835,18 +2068,15 @@ async def seek(client, message):
         to_seek = played_seconds - num
         if to_seek <= 10:
             return await bot.send_message(message.chat.id, "خطا", reply_to_message_id=message.id)
-    await change_stream(message.chat.id, playlist.get_full_form(message.chat.id, now_playing), seek=to_seek)
-    if not meta_data.get("seek"):
-        meta_data["seek"] = ""
-    meta_data["seek"] += f"{op}{num}"
-    playlist.compress(meta_data)
+    if not await change_stream(message.chat.id, await playlist.get_full_form(message.chat.id, now_playing), seek=await seek_point(meta_data, to_seek)):
+        return await bot.send_message(message.chat.id, STREAM_FAILED_TEXT, reply_to_message_id=message.id)
     await bot.send_message(message.chat.id, "{} ثانیه {} رفتیم.".format(num, "جلو" if op == "+" else "عقب"), reply_to_message_id=message.id)
     thumb, markup = await prepare_player(message.chat.id)
-    message_id = redis.hget(f"{BOT_ID}:PlayerMessage", message.chat.id)
+    message_id = await redis.hget(f"{BOT_ID}:PlayerMessage", message.chat.id)
     if message_id:
         try:
             played_seconds = await pytgcalls.played_time(message.chat.id)
-            await bot.edit_message_caption(message.chat.id, int(message_id), caption=playlist.display(now_playing, played_time=played_seconds), reply_markup=markup)
+            await bot.edit_message_caption(message.chat.id, int(message_id), caption=await playlist.display(now_playing), reply_markup=markup)
         except:
             pass
 
@@ -856,7 +2086,7 @@ async def seek(client, message):
 # @authorized_users
 # @has_active_call
 # async def volume(client, message):
-#     if not playlist.now(message.chat.id):
+#     if not await playlist.now(message.chat.id):
 #         return await message.reply("⚏ ویس چت در گروه فعال نیست ، ویس چت فعال کنید مجدد امتحان کنید !")
 #     op = re.match(r"^/(volume)\s(\+|\-)\s(\d+)$", message.text, re.M|re.I).group(2)
 #     num = int(re.match(r"^/(volume)\s(\+|\-)\s(\d+)$", message.text, re.M|re.I).group(3))
@@ -883,29 +2113,23 @@ async def play_file(client, message):
         title = message.reply_to_message.audio.title or ""
         item_type = "audio"
         duration = message.reply_to_message.audio.duration
-        if not redis.sismember(f"{BOT_ID}:Saved", message.reply_to_message.audio.file_id):
+        if not await redis.sismember(f"{BOT_ID}:Saved", message.reply_to_message.audio.file_id):
             msg = await bot.copy_message(DATABASE_CHANNEL, message.chat.id, message.reply_to_message.id)
-            redis.sadd(f"{BOT_ID}:Saved", message.reply_to_message.audio.file_id)
+            await redis.sadd(f"{BOT_ID}:Saved", message.reply_to_message.audio.file_id)
         msg_id = msg.id
         if message.reply_to_message.audio.thumbs:
-            name = message.reply_to_message.audio.file_name
-            thumb_id = message.reply_to_message.audio.thumbs[0].file_id
-            filename = hasher(f"{name}-{thumb_id}")
-            thumbnail = await bot.download_media(thumb_id, file_name=f"{filename}.png")
+            thumbnail = message.reply_to_message.audio.thumbs[0].file_id
     if message.reply_to_message.video:
         artist, title = "", ""
         thumbnail = None
         item_type = "video"
         duration = message.reply_to_message.video.duration
-        if not redis.sismember(f"{BOT_ID}:Saved", message.reply_to_message.video.file_id):
+        if not await redis.sismember(f"{BOT_ID}:Saved", message.reply_to_message.video.file_id):
             msg = await bot.copy_message(DATABASE_CHANNEL, message.chat.id, message.reply_to_message.id)
-            redis.sadd(f"{BOT_ID}:Saved", message.reply_to_message.video.file_id)
+            await redis.sadd(f"{BOT_ID}:Saved", message.reply_to_message.video.file_id)
             msg_id = msg.id
         if message.reply_to_message.video.thumbs:
-            name = message.reply_to_message.video.file_name
-            thumb_id = message.reply_to_message.video.thumbs[0].file_id
-            filename = hasher(f"{name}-{thumb_id}")
-            thumbnail = await bot.download_media(thumb_id, file_name=f"{filename}.png")
+            thumbnail = message.reply_to_message.video.thumbs[0].file_id
     data = {
         "identifier": "telegram",
         "id": f"{message.chat.id}/{message.reply_to_message_id}",
@@ -918,37 +2142,42 @@ async def play_file(client, message):
     if title:
         data["title"] = title
     pre_msg = await message.reply(f"🔄 در حال آماده سازی موزیک{' ویدئو' if item_type == 'video' else ''} ...")
-    cover_path = await cover(artist, title, type=item_type, duration=duration, thumbnail=thumbnail)
-    thumb_path = save_to("thumbnails", cover_path)
-    data["thumbnail"] = thumb_path
+    if thumbnail:
+        data["artwork"] = thumbnail
+    data["thumbnail"] = await cover(artist, title, type=item_type, duration=duration, thumbnail=thumbnail)
     msg = message.reply_to_message
     media = eval(f"msg.{item_type}")
-    _, ext = os.path.splitext(media.file_name)
-    filename = hasher(f"{media.file_name}-{media.file_id}")
-    await pre_msg.edit("⁂ در حال دانلود موزیک لطفا صبور باشید...")
-    file_path = await msg.download(file_name=f"{filename}{ext}")
-    data["path"] = save_to(f"{data['type']}s", file_path)
-    playlist.compress(data)
-    await pre_msg.edit("⁂ با موفقیت دانلود انجام شد.")
+    data["source"] = f"telegram:{media.file_unique_id}"
+    path = await media_cache.lookup(data["source"])
+    if path:
+        data["path"] = path
+    await playlist.compress(data)
     is_helper_ready = await prepare_helper(message.chat.id, message.id)
     if is_helper_ready:
         active_calls = [call for call in get_active_calls()]
-        _, _id = playlist.add(message.chat.id, data)
+        _, _id = await playlist.add(message.chat.id, data)
         if message.chat.id in active_calls:
-            pos = playlist.get_possition(message.chat.id, _id)
+            pos = await playlist.get_possition(message.chat.id, _id)
+            if not data.get("path"):
+                fetcher.ensure(message.chat.id, _id, priority=pos)
             if not _:
                 return await pre_msg.edit(f"⚏ این موزیک/ویدئو در جایگاه {pos} از لیست پخش شما قرار دارد .")
             await pre_msg.delete()
             return await message.reply_photo(data["thumbnail"], caption=f"⚏ این موزیک/ویدئو در جایگاه {pos} از لیست پخش شما قرار گرفت .")
         else:
-            stream = AudioPiped(data["path"], MediumQualityAudio())
-            if data["type"] == "video":
-                stream = AudioVideoPiped(data["path"], MediumQualityAudio(), MediumQualityVideo())
+            await pre_msg.edit("⁂ در حال دانلود موزیک لطفا صبور باشید...")
+            data = await ensure_track(message.chat.id, _id)
+            if not data:
+                await playlist.rem(message.chat.id, _id)
+                return await pre_msg.edit("⚏ دانلود موزیک با خطا مواجه شد، لطفا مجددا تلاش کنید ❗️")
+            await pre_msg.edit("⁂ با موفقیت دانلود انجام شد.")
+            stream = build_stream(data, audio_only=await playlist.audio_only(message.chat.id))
             try:
                 if len(active_calls) < pytgcalls.get_max_voice_chat():
                     await pytgcalls.join_group_call(message.chat.id, stream, stream_type=StreamType().pulse_stream)
-                    playlist.play(message.chat.id, _id)
-                    playlist.set_rule(message.chat.id, "queue")
+                    await playlist.play(message.chat.id, _id)
+                    await playlist.set_rule(message.chat.id, "queue")
+                    schedule_prefetch(message.chat.id, await playlist.get_full_form(message.chat.id, _id))
                     await pre_msg.delete()
                     await player(client, message)
                 else:
@@ -963,7 +2192,7 @@ async def play_file(client, message):
 async def play_search(client, message):
     text = re.match(r"^\/?(play|پخش)\s+(.*)$", message.text, re.M|re.I).group(2)
     rows = []
-    for i in rj.search(text):
+    for i in await search(text):
         icon = "🎵" if i["type"] == "audio" else "🎬"
         name = f"{icon} {i['artist']} - {i['title']}"
         rows.append([InlineKeyboardButton(name, f"song-{i['type']}-{i['id']}")])
@@ -980,12 +2209,13 @@ async def play_search(client, message):
 # @authorized_users
 async def startagain(client, message):
     chat_id = message.chat.id
-    _id = playlist.now(chat_id)
-    key = playlist.get_full_form(chat_id, _id)
-    await change_stream(chat_id, key)
+    _id = await playlist.now(chat_id)
+    key = await playlist.get_full_form(chat_id, _id)
+    if not await change_stream(chat_id, key):
+        return await bot.send_message(chat_id, STREAM_FAILED_TEXT, reply_to_message_id=message.id)
     thumb, markup = await prepare_player(chat_id)
-    player = await bot.send_photo(chat_id, thumb, caption=playlist.display(_id), reply_markup=markup)
-    redis.hset(f"{BOT_ID}:PlayerMessage", chat_id, player.id)
+    player = await bot.send_photo(chat_id, thumb, caption=await playlist.display(_id), reply_markup=markup)
+    await redis.hset(f"{BOT_ID}:PlayerMessage", chat_id, player.id)
 
 
 @bot.on_message(filters.regex(r"^\/?(startagainlist|از سرگیری لیست)$")  & filters.group)
@@ -993,12 +2223,13 @@ async def startagain(client, message):
 # @authorized_users
 async def startagainlist(client, message):
     chat_id = message.chat.id
-    _, _id = playlist.split_key(playlist.get(chat_id)[0])
-    key = playlist.get_full_form(chat_id, _id)
-    await change_stream(chat_id, key)
+    _, _id = playlist.split_key(await playlist.first(chat_id))
+    key = await playlist.get_full_form(chat_id, _id)
+    if not await change_stream(chat_id, key):
+        return await bot.send_message(chat_id, STREAM_FAILED_TEXT, reply_to_message_id=message.id)
     thumb, markup = await prepare_player(chat_id)
-    player = await bot.send_photo(chat_id, thumb, caption=playlist.display(_id), reply_markup=markup)
-    redis.hset(f"{BOT_ID}:PlayerMessage", chat_id, player.id)
+    player = await bot.send_photo(chat_id, thumb, caption=await playlist.display(_id), reply_markup=markup)
+    await redis.hset(f"{BOT_ID}:PlayerMessage", chat_id, player.id)
 
 
 @bot.on_callback_query(filters.regex(r'^(song)-(audio|video)-(\d+)$'))
@@ -1012,41 +2243,35 @@ async def search_select(client, callbackquery):
     if is_helper_ready:
         text = f"🔄 در حال آماده سازی موزیک{' ویدئو' if item_type == 'video' else ''} انتخابی شما ..."
         await bot.edit_message_text(callbackquery.message.chat.id, callbackquery.message.id, text=text)
-        if item_type == "video":
-            result = rj.get_video(item_id)
-        else:
-            result = rj.get_audio(item_id)
-        cover_path = await cover(result["artist"], result["title"], type=item_type, duration=result.get("duration", None), thumbnail=result.get("thumbnail", None))
-        thumb_path = save_to("thumbnails", cover_path)
-        result["thumbnail"] = thumb_path
-        result["identifier"] = "radiojavan"
-        _, ext = os.path.splitext(result["link"])
-        filename = hasher(f"{result['title']}-{result['id']}")
-        await bot.edit_message_text(callbackquery.message.chat.id, callbackquery.message.id, text="⁂ در حال دانلود موزیک لطفا صبور باشید...")
-        file_path = download_url(result["link"], f"{filename}{ext}")
-        result["path"] = save_to(f"{result['type']}s", file_path)
-        playlist.compress(result)
+        result = await prepare_radiojavan(item_type, item_id)
+        await playlist.compress(result)
         active_calls = [call for call in get_active_calls()]
-        _, _id = playlist.add(callbackquery.message.chat.id, result)
+        _, _id = await playlist.add(callbackquery.message.chat.id, result)
         if callbackquery.message.chat.id in active_calls:
-            pos = playlist.get_possition(callbackquery.message.chat.id, _id)
+            pos = await playlist.get_possition(callbackquery.message.chat.id, _id)
+            if not result.get("path"):
+                fetcher.ensure(callbackquery.message.chat.id, _id, priority=pos)
             if not _:
                 return await bot.edit_message_caption(callbackquery.message.chat.id, callbackquery.message.id, caption=f"⚏ این موزیک/ویدئو در جایگاه {pos} از لیست پخش شما قرار دارد .")
             await bot.delete_messages(callbackquery.message.chat.id, callbackquery.message.id)
             return await bot.send_photo(callbackquery.message.chat.id, result["thumbnail"], caption=f"⚏ این موزیک/ویدئو در جایگاه {pos} از لیست پخش شما قرار گرفت .")
         else:
-            stream = AudioPiped(result["path"], MediumQualityAudio())
-            if result["type"] == "video":
-                stream = AudioVideoPiped(result["path"], MediumQualityAudio(), MediumQualityVideo())
+            progress = download_progress(callbackquery.message.chat.id, callbackquery.message.id, "⁂ در حال دانلود موزیک لطفا صبور باشید...")
+            result = await ensure_track(callbackquery.message.chat.id, _id, progress)
+            if not result:
+                await playlist.rem(callbackquery.message.chat.id, _id)
+                return await bot.edit_message_text(callbackquery.message.chat.id, callbackquery.message.id, text="⚏ دانلود موزیک با خطا مواجه شد، لطفا مجددا تلاش کنید ❗️")
+            stream = build_stream(result, audio_only=await playlist.audio_only(callbackquery.message.chat.id))
             try:
                 if len(active_calls) < pytgcalls.get_max_voice_chat():
                     await pytgcalls.join_group_call(callbackquery.message.chat.id, stream, stream_type=StreamType().pulse_stream)
-                    playlist.play(callbackquery.message.chat.id, _id)
-                    playlist.set_rule(callbackquery.message.chat.id, "queue")
+                    await playlist.play(callbackquery.message.chat.id, _id)
+                    await playlist.set_rule(callbackquery.message.chat.id, "queue")
+                    schedule_prefetch(callbackquery.message.chat.id, await playlist.get_full_form(callbackquery.message.chat.id, _id))
                     await bot.delete_messages(callbackquery.message.chat.id, callbackquery.message.id)
                     thumb, markup = await prepare_player(callbackquery.message.chat.id)
-                    player = await bot.send_photo(callbackquery.message.chat.id, result["thumbnail"], caption=playlist.display(playlist.now(callbackquery.message.chat.id)), reply_markup=markup)
-                    redis.hset(f"{BOT_ID}:PlayerMessage", callbackquery.message.chat.id, player.id)
+                    player = await bot.send_photo(callbackquery.message.chat.id, result["thumbnail"], caption=await playlist.display(await playlist.now(callbackquery.message.chat.id)), reply_markup=markup)
+                    await redis.hset(f"{BOT_ID}:PlayerMessage", callbackquery.message.chat.id, player.id)
                 else:
                     return await bot.edit_message_caption(callbackquery.message.chat.id, callbackquery.message.id, caption="⚏ ربات در حداکثر تعداد وویس چت ممکن عضو شده است و تحت فشار است، لطفا بعدا مجددا تلاش فرمایید ❗️")
             except tgerrors.NoActiveGroupCall:
@@ -1061,33 +2286,35 @@ async def manage(client, callbackquery):
     chat_id = callbackquery.message.chat.id
     message_id = callbackquery.message.id
     if command == "previous":
-        if not playlist.previous(chat_id):
+        if not await playlist.previous(chat_id):
             return await callbackquery.answer("⚏ موزیک قبلی در لیست پخش وجود ندارد .", show_alert=True)
-        key = playlist.previous(chat_id)
-        await change_stream(chat_id, key)
+        key = await playlist.previous(chat_id)
+        if not await change_stream(chat_id, key):
+            return await callbackquery.answer(STREAM_FAILED_TEXT, show_alert=True)
         await edit_player(chat_id, key)
     elif command == "next":
-        if not playlist.next(chat_id):
+        if not await playlist.next(chat_id):
             return await callbackquery.answer("⚏ موزیک بعدی در لیست پخش وجود ندارد .", show_alert=True)
-        key = playlist.next(chat_id, force=True)
-        await change_stream(chat_id, key)
+        key = await playlist.next(chat_id, force=True)
+        if not await change_stream(chat_id, key):
+            return await callbackquery.answer(STREAM_FAILED_TEXT, show_alert=True)
         await edit_player(chat_id, key)
     elif command == "pause":
         await pytgcalls.pause_stream(chat_id)
-        playlist.pause(chat_id)
+        await playlist.pause(chat_id)
         await callbackquery.answer("⚏ پخش زنده با موفقیت متوقف شد .", show_alert=True)
         thumb, markup = await prepare_player(chat_id)
         await bot.edit_message_reply_markup(chat_id, message_id, markup)
     elif command == "resume":
         await pytgcalls.resume_stream(chat_id)
-        playlist.resume(chat_id)
+        await playlist.resume(chat_id)
         await callbackquery.answer("⚏ پخش زنده از سر گرفته شد .", show_alert=True)
         thumb, markup = await prepare_player(chat_id)
         await bot.edit_message_reply_markup(chat_id, message_id, markup)
     elif command == "stop":
         await delete_last_player(chat_id)
         await leave_group_call(chat_id)
-        playlist.clear(chat_id)
+        await playlist.clear(chat_id)
         await bot.send_message(chat_id, "⚏ پخش زنده با موفقیت متوقف شد .")
     elif command == "close":
         await bot.edit_message_reply_markup(chat_id, message_id, None)
@@ -1096,8 +2323,8 @@ async def manage(client, callbackquery):
         markup = await prepare_playlist(chat_id)
         await bot.send_message(chat_id, "⚏ برای پخش موزیک خارج از نوبت روی آن کلیک کنید :", reply_markup=markup)
     elif command == "download":
-        now_playing = playlist.now(chat_id)
-        meta_data = playlist.extract(now_playing)
+        now_playing = await playlist.now(chat_id)
+        meta_data = await playlist.extract(now_playing)
         txt = ""
         if meta_data["identifier"] == "radiojavan":
             size = os.stat(meta_data["path"])
@@ -1113,24 +2340,24 @@ async def manage(client, callbackquery):
                 txt += "⏱ زمان : {}".format(playlist.convert_seconds(meta_data['duration']))
             txt += "\nⓂ️ حجم : {:,} مگابایت".format(size)
             if size <= 20:
-                if not redis.hget(f"{BOT_ID}:MessageID", meta_data["id"]):
-                    if not redis.sismember(f"{BOT_ID}:Saved", meta_data["id"]):
-                        if redis.hget(f"{BOT_ID}:InProgress", meta_data["id"]):
+                if not await redis.hget(f"{BOT_ID}:MessageID", meta_data["id"]):
+                    if not await redis.sismember(f"{BOT_ID}:Saved", meta_data["id"]):
+                        if await redis.hget(f"{BOT_ID}:InProgress", meta_data["id"]):
                             return await callbackquery.answer("⚏ این فایل د رحال آپلود می باشد ...", show_alert=True)
                         await callbackquery.answer("⚏ آپلود فایل آغاز شد ...", show_alert=True)
-                        redis.hset(f"{BOT_ID}:InProgress", meta_data["id"], "true")
+                        await redis.hset(f"{BOT_ID}:InProgress", meta_data["id"], "true")
                         _, ext = os.path.splitext(meta_data["path"])
                         if meta_data["type"] == "video":
                             vid = cv2.VideoCapture(meta_data["path"])
                             height = vid.get(cv2.CAP_PROP_FRAME_HEIGHT)
                             width = vid.get(cv2.CAP_PROP_FRAME_WIDTH)
-                            msg = await bot.send_video(DATABASE_CHANNEL, open(meta_data["path"], "rb"), caption="{}".format(txt), file_name=f"{meta_data['title']}{ext}", height=math.ceil(height), width=math.ceil(width), duration=int(meta_data["duration"]), thumb=open(meta_data["thumbnail"], "rb"))
+                            msg = await bot.send_video(DATABASE_CHANNEL, open(meta_data["path"], "rb"), caption="{}".format(txt), file_name=f"{meta_data['title']}{ext}", height=math.ceil(height), width=math.ceil(width), duration=int(meta_data["duration"]), thumb=open(await track_cover(meta_data), "rb"))
                         else:
                             msg = await bot.send_audio(DATABASE_CHANNEL, open(meta_data["path"], "rb"), caption="{}".format(txt), file_name=f"{meta_data['title']}{ext}", performer=meta_data["artist"], title=meta_data["title"])
-                        redis.hdel(f"{BOT_ID}:InProgress", meta_data["id"])
-                        redis.sadd(f"{BOT_ID}:Saved", meta_data["id"])
-                        redis.hset(f"{BOT_ID}:MessageID", meta_data["id"], msg.id)
-                msg_id = redis.hget(f"{BOT_ID}:MessageID", meta_data["id"])
+                        await redis.hdel(f"{BOT_ID}:InProgress", meta_data["id"])
+                        await redis.sadd(f"{BOT_ID}:Saved", meta_data["id"])
+                        await redis.hset(f"{BOT_ID}:MessageID", meta_data["id"], msg.id)
+                msg_id = await redis.hget(f"{BOT_ID}:MessageID", meta_data["id"])
                 return await bot.copy_message(callbackquery.message.chat.id, DATABASE_CHANNEL, int(msg_id))
             else:
                 return await bot.send_message(callbackquery.message.chat.id, "{}\n🔗 <a href='{}'>لینک دانلود</a>".format(txt, meta_data["link"]), parse_mode=ParseMode.HTML)
@@ -1140,8 +2367,8 @@ async def manage(client, callbackquery):
         await bot.delete_messages(chat_id, message_id)
         thumb, markup = await prepare_player(chat_id)
         played_seconds = await pytgcalls.played_time(chat_id)
-        player = await bot.send_photo(chat_id, thumb, caption=playlist.display(playlist.now(chat_id), played_time=played_seconds), reply_markup=markup)
-        redis.hset(f"{BOT_ID}:PlayerMessage", chat_id, player.id)
+        player = await bot.send_photo(chat_id, thumb, caption=await playlist.display(await playlist.now(chat_id), played_time=played_seconds), reply_markup=markup)
+        await redis.hset(f"{BOT_ID}:PlayerMessage", chat_id, player.id)
 
 
 @bot.on_callback_query(filters.regex(r'^(changerule)-(.*)$'))
@@ -1157,7 +2384,7 @@ async def change_rule(client, callbackquery):
     if index == len(rules):
         index = 0
     next_rule = rules[index]
-    playlist.set_rule(chat_id, next_rule)
+    await playlist.set_rule(chat_id, next_rule)
     await callbackquery.answer(f"⚠️ حالت پخش تنظیم شد روی : {actions[index]} ⚠️", show_alert=True)
     thumb, markup = await prepare_player(chat_id)
     await bot.edit_message_reply_markup(chat_id, message_id, markup)
@@ -1182,11 +2409,12 @@ async def playforce(client, callbackquery):
     chat_id = callbackquery.message.chat.id
     message_id = callbackquery.message.id
     await bot.delete_messages(chat_id, message_id)
-    key = playlist.get_full_form(chat_id, _id)
-    await change_stream(chat_id, key)
+    key = await playlist.get_full_form(chat_id, _id)
+    if not await change_stream(chat_id, key):
+        return await bot.send_message(chat_id, STREAM_FAILED_TEXT)
     thumb, markup = await prepare_player(chat_id)
-    player = await bot.send_photo(chat_id, thumb, caption=playlist.display(_id), reply_markup=markup)
-    redis.hset(f"{BOT_ID}:PlayerMessage", chat_id, player.id)
+    player = await bot.send_photo(chat_id, thumb, caption=await playlist.display(_id), reply_markup=markup)
+    await redis.hset(f"{BOT_ID}:PlayerMessage", chat_id, player.id)
 
 
 @bot.on_callback_query(filters.regex(r'^(delete)-(.*)$'))
@@ -1196,25 +2424,27 @@ async def delete_playlist_item(client, callbackquery):
     _id = re.match(r'^(delete)-(.*)$', callbackquery.data, re.M|re.I).group(2)
     chat_id = callbackquery.message.chat.id
     message_id = callbackquery.message.id
-    key = playlist.get_full_form(chat_id, _id)
-    plylist = playlist.get(chat_id)
-    now_playing = playlist.now(chat_id)
-    if len(plylist) == 1:
+    key = await playlist.get_full_form(chat_id, _id)
+    if key is None:
+        return await callbackquery.answer("⚏ این مورد در لیست پخش وجود ندارد .", show_alert=True)
+    now_playing = await playlist.now(chat_id)
+    if await playlist.count(chat_id) == 1:
         await delete_last_player(chat_id)
         await leave_group_call(chat_id)
-        playlist.clear(chat_id)
+        await playlist.clear(chat_id)
         return await bot.edit_message_text(chat_id, message_id, "لیست پخش خالی و پخش زنده متوقف شد.")
     if now_playing == _id:
-        next_key = playlist.next(chat_id, force=True)
-        playlist.rem(chat_id, _id)
-        await change_stream(chat_id, next_key)
+        next_key = await playlist.next(chat_id, force=True)
+        await playlist.rem(chat_id, _id)
+        if not await change_stream(chat_id, next_key):
+            return await bot.edit_message_text(chat_id, message_id, f"حذف شد.\n{STREAM_FAILED_TEXT}")
         await callbackquery.answer("حذف شد", show_alert=True)
         await bot.delete_messages(chat_id, message_id)
         thumb, markup = await prepare_player(chat_id)
-        player = await bot.send_photo(chat_id, thumb, caption=playlist.display(_id), reply_markup=markup)
-        redis.hset(f"{BOT_ID}:PlayerMessage", chat_id, player.id)
+        player = await bot.send_photo(chat_id, thumb, caption=await playlist.display(_id), reply_markup=markup)
+        await redis.hset(f"{BOT_ID}:PlayerMessage", chat_id, player.id)
         return
-    playlist.rem(chat_id, _id)
+    await playlist.rem(chat_id, _id)
     await bot.edit_message_text(chat_id, message_id, "حذف شد.")
 
 
@@ -1227,10 +2457,9 @@ async def seek_cb(client, callbackquery):
     chat_id = callbackquery.message.chat.id
     message_id = callbackquery.message.id
     played_seconds = await pytgcalls.played_time(chat_id)
-    now_playing = playlist.now(chat_id)
-    meta_data = playlist.extract(now_playing)
-    if meta_data.get("seek"):
-        played_seconds += eval(meta_data["seek"])
+    now_playing = await playlist.now(chat_id)
+    meta_data = await playlist.extract(now_playing)
+    played_seconds += playlist.offset(meta_data)
     if op == "+":
         to_seek = played_seconds + num
         if int(meta_data["duration"]) - to_seek <= 10:
@@ -1239,34 +2468,60 @@ async def seek_cb(client, callbackquery):
         to_seek = played_seconds - num
         if to_seek <= 10:
             return await callbackquery.answer("خطا", show_alert=True)
-    await change_stream(chat_id, playlist.get_full_form(chat_id, now_playing), seek=to_seek)
-    if not meta_data.get("seek"):
-        meta_data["seek"] = ""
-    meta_data["seek"] += f"{op}{num}"
-    playlist.compress(meta_data)
+    if not await change_stream(chat_id, await playlist.get_full_form(chat_id, now_playing), seek=await seek_point(meta_data, to_seek)):
+        return await callbackquery.answer(STREAM_FAILED_TEXT, show_alert=True)
     await callbackquery.answer("{} ثانیه {} رفتیم.".format(num, "جلو" if op == "+" else "عقب"), show_alert=True)
     thumb, markup = await prepare_player(chat_id)
     try:
-        await bot.edit_message_caption(chat_id, message_id, caption=playlist.display(now_playing, played_time=played_seconds), reply_markup=markup)
+        await bot.edit_message_caption(chat_id, message_id, caption=await playlist.display(now_playing), reply_markup=markup)
     except:
         pass
 
 
+@bot.on_message(filters.regex(r"^\/(stats)$") & filters.user(SUDO_USERS))
+async def stats(client, message):
+    cache = playlist.cache.stats()
+    text = "📊 کش اطلاعات آهنگ ها :\n"
+    text += f"⚏ تعداد : {cache['size']}\n"
+    text += f"⚏ موفق : {cache['hits']}\n"
+    text += f"⚏ ناموفق : {cache['misses']}\n"
+    text += f"⚏ نرخ موفقیت : {cache['ratio']:.0%}"
+    switches = [seconds for seconds in stream_stats if seconds is not None]
+    text += "\n\n🎚 تعویض استریم :\n"
+    text += f"⚏ تعداد : {len(stream_stats)}\n"
+    text += f"⚏ ناموفق : {len(stream_stats) - len(switches)}\n"
+    if switches:
+        text += f"⚏ میانگین : {sum(switches) / len(switches):.2f} ثانیه\n"
+        text += f"⚏ بیشترین : {max(switches):.2f} ثانیه"
+    text += "\n\n🔎 جستجوی اینلاین :\n"
+    text += f"⚏ پاسخ داده شده : {inline_stats['served']}\n"
+    text += f"⚏ لغو شده : {inline_stats['dropped']}"
+    await message.reply(text)
+
+
 ############################### End Command Manager ###############################
 
 async def main():
     async with Client(f"{ID_BOT}-bot-cli", api_id=API_ID, api_hash=API_HASH, in_memory=True) as app:
         session_string = await app.export_session_string()
-        redis.set(f"{ID_BOT}:SessionString", session_string)
+        await redis.set(f"{ID_BOT}:SessionString", session_string)
         print(f"{Fore.GREEN}Logged In Successfully!")
         sys.exit(0)
 
 
-if not redis.get(f"{ID_BOT}:SessionString"):
-    loop = asyncio.get_event_loop()
+if not SESSION_STRING:
     loop.run_until_complete(main())
 
 
+loop.run_until_complete(migrate_playlists())
 bot.start()
 pytgcalls.start()
+loop.create_task(migrate_legacy_data())
+loop.create_task(scan_media())
+fetcher.start(loop)
+loop.create_task(playlist.watch())
+loop.create_task(playlist.reap())
 idle()
+loop.run_until_complete(downloader.close())
+loop.run_until_complete(rj.close())
+loop.run_until_complete(covers.close())
@@ -0,0 +1,70 @@
+import asyncio
+import os
+import time
+
+import aiofiles
+import aiohttp
+
+
+class Downloader:
+
+    def __init__(self, connections=8, timeout=30, chunk_size=256 * 1024, retries=3, progress_interval=3):
+        self.connections = connections
+        self.timeout = aiohttp.ClientTimeout(total=None, connect=timeout, sock_read=timeout)
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.progress_interval = progress_interval
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.connections)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def download(self, url, filename, progress=None):
+        # Bytes land in filename.part and only move into place when complete,
+        # so a failed or interrupted download resumes from where it stopped.
+        for attempt in range(1, self.retries + 1):
+            try:
+                return await self._fetch(url, filename, progress)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+
+    async def _fetch(self, url, filename, progress):
+        part = f"{filename}.part"
+        done = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {"Range": f"bytes={done}-"} if done else {}
+        async with self.session.get(url, headers=headers) as response:
+            if response.status == 416:
+                # Nothing left past what we have, the part file is complete
+                # unless the remote copy changed size underneath it.
+                _, _, size = response.headers.get("Content-Range", "").partition("/")
+                if size.isdigit() and int(size) == done:
+                    os.replace(part, filename)
+                    return filename
+                os.remove(part)
+                raise aiohttp.ClientPayloadError(f"{url} changed while resuming")
+            response.raise_for_status()
+            if response.status != 206:
+                done = 0
+            total = done + response.content_length if response.content_length else None
+            reported = 0
+            async with aiofiles.open(part, mode="ab" if done else "wb") as f:
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    await f.write(chunk)
+                    done += len(chunk)
+                    if progress and time.monotonic() - reported >= self.progress_interval:
+                        reported = time.monotonic()
+                        await progress(done, total)
+        if total is not None and done < total:
+            raise aiohttp.ClientPayloadError(f"{url} ended after {done} of {total} bytes")
+        os.replace(part, filename)
+        return filename
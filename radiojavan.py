@@ -1,14 +1,185 @@
-import requests
-from urllib.parse import quote
+import asyncio
+import random
+import struct
+
+import aiohttp
 import cv2
 
 
-class RadioJavan:
+def parse_search(data):
+    results = []
+    for i in data['mp3s']:
+        results.append({
+            "id": i["id"],
+            "artist": i["artist"],
+            "title": i["song"],
+            "link": i["link"],
+            "thumbnail": i["photo"],
+            "type": "audio"
+        })
+    for i in data['videos']:
+        results.append({
+            "id": i["id"],
+            "artist": i["artist"],
+            "title": i["song"],
+            "link": i["link"],
+            "thumbnail": i["photo"],
+            "type": "video"
+        })
+    return results
+
+
+def parse_audio(res):
+    return {
+        "id": res["id"],
+        "artist": res["artist"],
+        "title": res["song"],
+        "duration": int(res["duration"]),
+        "link": res["link"],
+        "thumbnail": res["photo"],
+        "type": "audio"
+    }
+
+
+def parse_video(res, duration):
+    return {
+        "id": res["id"],
+        "artist": res["artist"],
+        "title": res["song"],
+        "duration": duration,
+        "link": res["link"],
+        "thumbnail": res["photo"],
+        "type": "video"
+    }
+
+
+def parse_mvhd(moov):
+    # mvhd is normally the first child of moov, duration / timescale is the
+    # length of the whole presentation.
+    position = 0
+    while position + 8 <= len(moov):
+        size, kind = struct.unpack(">I4s", moov[position:position + 8])
+        if kind == b"mvhd":
+            body = moov[position + 8:position + size]
+            if body[:1] == b"\x01" and len(body) >= 32:
+                timescale, duration = struct.unpack(">IQ", body[20:32])
+            elif len(body) >= 20:
+                timescale, duration = struct.unpack(">II", body[12:20])
+            else:
+                return None
+            return duration / timescale if timescale else None
+        if size < 8:
+            return None
+        position += size
+    return None
+
+
+class AsyncRadioJavan:
+
+    base_url = "https://api-rjvn.app/api2"
+
+    def __init__(self, base_url=None, connections=10, timeout=10, retries=3, backoff=0.5, concurrency=8, durations=None):
+        # durations is any object with async get(video_id) and
+        # set(video_id, seconds), probed lengths are kept there.
+        self.durations = durations
+        if base_url:
+            self.base_url = base_url.rstrip("/")
+        self.connections = connections
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.concurrency = concurrency
+        self._session = None
+        self._limit = None
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.connections, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._limit = asyncio.Semaphore(self.concurrency)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def _get(self, path, **params):
+        session = self.session
+        for attempt in range(1, self.retries + 1):
+            try:
+                async with self._limit:
+                    async with session.get(f"{self.base_url}/{path}", params=params) as res:
+                        res.raise_for_status()
+                        return await res.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+                # Full jitter keeps a burst of failed calls from retrying in step.
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
 
-    _search_url = "https://api-rjvn.app/api2/search?query={query}"
-    _audio_url = "https://api-rjvn.app/api2/mp3?id={id}"
-    _video_url = "https://api-rjvn.app/api2/video/{id}"
+    async def _range(self, url, start, end):
+        async with self.session.get(url, headers={"Range": f"bytes={start}-{end}"}) as res:
+            if res.status != 206:
+                # No range support, bail out before the body is read.
+                return None, None
+            _, _, total = res.headers.get("Content-Range", "").rpartition("/")
+            return await res.read(), int(total) if total.isdigit() else None
 
+    async def probe_duration(self, url, chunk=65536, hops=16):
+        # Walk the top level MP4 boxes with range requests, skipping over
+        # mdat, until moov turns up, then read just enough of it for mvhd.
+        offset = 0
+        for _ in range(hops):
+            data, total = await self._range(url, offset, offset + chunk - 1)
+            if not data:
+                return None
+            position = 0
+            while position + 8 <= len(data):
+                size, kind = struct.unpack(">I4s", data[position:position + 8])
+                header = 8
+                if size == 1:
+                    if position + 16 > len(data):
+                        break
+                    size = struct.unpack(">Q", data[position + 8:position + 16])[0]
+                    header = 16
+                elif size == 0 and total:
+                    size = total - offset - position
+                if size < header:
+                    return None
+                if kind == b"moov":
+                    if position + size <= len(data):
+                        return parse_mvhd(data[position + header:position + size])
+                    start = offset + position + header
+                    moov, _ = await self._range(url, start, start + min(size - header, chunk) - 1)
+                    return parse_mvhd(moov) if moov else None
+                position += size
+            offset += position
+            if total is not None and offset >= total:
+                return None
+        return None
+
+    async def get_duration(self, video_id, url):
+        if self.durations is not None:
+            duration = await self.durations.get(video_id)
+            if duration:
+                return int(float(duration))
+        duration = None
+        for attempt in range(1, self.retries + 1):
+            try:
+                duration = await self.probe_duration(url)
+                break
+            except struct.error:
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    break
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+        if not duration:
+            duration = await asyncio.get_running_loop().run_in_executor(None, self.get_video_time, url)
+        if self.durations is not None and duration:
+            await self.durations.set(video_id, int(duration))
+        return int(duration)
 
     def get_video_time(self, url):
         video = cv2.VideoCapture(url)
@@ -16,52 +187,38 @@ class RadioJavan:
         fps = video.get(cv2.CAP_PROP_FPS)
         return int(frames / fps)
 
-    def search(self, query):
-        res = requests.get(self._search_url.format(query=quote(query)))
-        data = res.json()
-        for i in data['mp3s']:
-            yield {
-                "id": i["id"],
-                "artist": i["artist"],
-                "title": i["song"],
-                "link": i["link"],
-                "thumbnail": i["photo"],
-                "type": "audio"
-                
-            }
-        for i in data['videos']:
-            yield {
-                "id": i["id"],
-                "artist": i["artist"],
-                "title": i["song"],
-                "link": i["link"],
-                "thumbnail": i["photo"],
-                "type": "video"
-                
-            }
+    async def search(self, query):
+        return parse_search(await self._get("search", query=query))
 
+    async def get_audio(self, audio_id):
+        return parse_audio(await self._get("mp3", id=audio_id))
 
-    def get_audio(self, audio_id):
-        res = requests.get(self._audio_url.format(id=audio_id)).json()
-        return {
-            "id": res["id"],
-            "artist": res["artist"],
-            "title": res["song"],
-            "duration": int(res["duration"]),
-            "link": res["link"],
-            "thumbnail": res["photo"],
-            "type": "audio"
-        }
+    async def get_video(self, video_id):
+        res = await self._get(f"video/{video_id}")
+        return parse_video(res, await self.get_duration(res["id"], res["link"]))
+
+
+class RadioJavan:
+
+    def __init__(self, base_url=None, **kwargs):
+        self._loop = asyncio.new_event_loop()
+        self._client = AsyncRadioJavan(base_url, **kwargs)
 
+    def _run(self, coro):
+        return self._loop.run_until_complete(coro)
+
+    def get_video_time(self, url):
+        return self._client.get_video_time(url)
+
+    def search(self, query):
+        yield from self._run(self._client.search(query))
+
+    def get_audio(self, audio_id):
+        return self._run(self._client.get_audio(audio_id))
 
     def get_video(self, video_id):
-        res = requests.get(self._video_url.format(id=video_id)).json()
-        return {
-            "id": res["id"],
-            "artist": res["artist"],
-            "title": res["song"],
-            "duration": self.get_video_time(res["link"]),
-            "link": res["link"],
-            "thumbnail": res["photo"],
-            "type": "video"
-        }
+        return self._run(self._client.get_video(video_id))
+
+    def close(self):
+        self._run(self._client.close())
+        self._loop.close()